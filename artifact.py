@@ -0,0 +1,88 @@
+# coding: utf-8
+
+"""
+content-hashed stage artifacts for the incremental pipeline (pipeline.py).
+
+when a stage finishes (level, page), a manifest {MANIFEST_DIRPATH}/{level}_{stage}_{page}.json records
+the key of its output: a hash of its inputs and of the config values the stage depends on.
+a stage is up to date when the recorded key equals the current key and the output still exists,
+so a rerun skips finished work and an interrupted run resumes at the first unfinished page.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+import ciputil
+import flowstore
+
+#config values on which the output of each stage depends.
+#file paths and options that do not change the values (STREAMING, RECALCULATE, ...) are not included.
+STAGE_CONFIG = {
+    "stabilize" : [("STABILIZE", "ANGLE_THRESH")],
+    "cumulative": [("CUMULATIVE", "WINDOW_SIZE"), ("CUMULATIVE", "INTERPOLATION"), ("CUMULATIVE", "REDUCED_GRID"), ("FLOW", "BACKEND"),
+                   ("STORE", "FORMAT"), ("STORE", "DTYPE"), ("STORE", "CROP")],
+    "dot"       : [("DOT", "WINDOW_SIZE"), ("DOT", "FLOW_THRESHOLD"),
+                   ("STORE", "FORMAT"), ("STORE", "DTYPE"), ("STORE", "CROP")],
+    "candidates": [("CUMULATIVE", "WINDOW_SIZE"), ("CUMULATIVE", "INTERPOLATION"), ("CUMULATIVE", "REDUCED_GRID"), ("FLOW", "BACKEND"),
+                   ("DOT", "WINDOW_SIZE"), ("DOT", "FLOW_THRESHOLD"), ("DETECT", "DOT_THRESHOLD"),
+                   ("STORE", "FORMAT"), ("STORE", "DTYPE"), ("STORE", "CROP")],
+    "detect"    : [("DETECT", "DOT_THRESHOLD"), ("DETECT", "SUBSAMPLE"), ("DETECT", "CLUSTERING"),
+                   ("DETECT", "EPS"), ("DETECT", "MIN_SAMPLES")],
+}
+
+def hash_values(*value_lst):
+    """
+    sha1 of values. numpy arrays are hashed by their contents.
+    """
+    sha = hashlib.sha1()
+    for value in value_lst:
+        if isinstance(value, np.ndarray):
+            sha.update(repr((value.dtype.str, value.shape)).encode())
+            sha.update(np.ascontiguousarray(value).tobytes())
+        else:
+            sha.update(repr(value).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+def stage_key(stage, config, *input_lst):
+    """
+    key of the output of stage made from input_lst (keys of upstream outputs, arrays, fingerprints)
+    """
+    configValue_lst = [(section, key, config[section][key]) for section, key in STAGE_CONFIG[stage]]
+    return hash_values(stage, configValue_lst, *input_lst)
+
+def image_fingerprint(page, timemax):
+    """
+    hash of path, size and modification time of the images of a page (of ciputil.LEVEL)
+    """
+    stat_lst = []
+    for time in range(1, timemax + 1):
+        filepath = ciputil.image_filepath(time, page)
+        stat = os.stat(filepath)
+        stat_lst.append((filepath, stat.st_size, stat.st_mtime_ns))
+    return hash_values(stat_lst)
+
+def manifest_filepath(manifestDirpath, stage, level, page=None):
+    return manifestDirpath + "/{0}_{1}_{2}.json".format(level, stage, "all" if page is None else page)
+
+def is_up_to_date(manifestDirpath, stage, level, page, key):
+    filepath = manifest_filepath(manifestDirpath, stage, level, page)
+    if not os.path.exists(filepath):
+        return False
+    with open(filepath, "r") as f:
+        manifest = json.load(f)
+    output = manifest["output"]
+    outputExists = os.path.exists(output) or os.path.isdir(flowstore.store_dirpath(output))
+    return manifest["key"] == key and outputExists
+
+def record(manifestDirpath, stage, level, page, key, output):
+    """
+    record that output of (stage, level, page) was made with key
+    """
+    os.makedirs(manifestDirpath, exist_ok=True)
+    filepath = manifest_filepath(manifestDirpath, stage, level, page)
+    with open(filepath + ".tmp", "w") as f:
+        json.dump({"key": key, "output": output}, f)
+    os.replace(filepath + ".tmp", filepath)
@@ -0,0 +1,271 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+benchmark of the stages on synthetic image stacks, without the ALCON datasets.
+
+a synthetic level has the same layout as the real data (Pre_Data{level}/t{time}/..._page_{page}.tif and
+Eva_Data{level}/input.csv), with cells on a noisy background, a random drift of the whole image over time
+and division events (a cell splits into two cells moving apart over some pages).
+for each scale (TIME_MAX x PAGE_MAX) these entry points are timed:
+    stabilize                : stabilize.calc_fix_direction
+    stabilized_flows         : cumulative_flow.calc_stabilized_flows (page 1)
+    cumulative_flows         : cumulative_flow.calc_cumulative_flows_vectorized (page 1)
+    cumulative_flows_fast    : cumulative_flow.calc_cumulative_flows_fast (page 1, only with --reference: it is a per-pixel loop)
+    dot_product              : dot_product.calc_dot_product (page 1)
+    classify                 : detect.classify (candidates of page 1, repeated on all pages)
+wall time, CPU time and peak RSS of each are appended to RESULTS_FILEPATH (JSON lines),
+and compared with the previous result of the same stage and scale.
+stages use the config "config/config.ini" except BASEDIR, OUTPUT_VIDEO and [CACHE] MEMMAP.
+
+with --startup, the startup of the entry points (ENTRY_POINTS) is timed instead: a new interpreter importing
+the module, as a worker of a scheduler does for each short job. the record of "startup_{module}" has the median
+of REPEAT runs and the heavy modules (HEAVY_MODULES) loaded by the import.
+
+usage: ./benchmark.py [--scale 6x3 12x4 ...] [--dirpath DIRPATH] [--results RESULTS_FILEPATH] [--seed SEED] [--reference]
+       ./benchmark.py --startup [--repeat REPEAT] [--results RESULTS_FILEPATH]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import resource
+import numpy as np
+import cv2
+
+import ciputil
+import instrument
+import stabilize
+import cumulative_flow
+import dot_product
+import detect
+
+LEVEL = 99  # level of the synthetic stacks
+ENTRY_POINTS = ["stabilize", "cumulative_flow", "dot_product", "candidates", "detect", "pipeline", "sweep"]
+HEAVY_MODULES = ["cv2", "pandas", "sklearn", "matplotlib"]
+#run in a new interpreter: print peak RSS (MB) and the heavy modules loaded by importing the module
+STARTUP_CODE = """import sys, json, resource
+import {module}
+print(json.dumps([resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, [name for name in {heavy} if name in sys.modules]]))"""
+
+
+def make_stack(basedir, level, timemax, pagemax, numCell=60, drift=3.0, numDivision=3, seed=0):
+    """
+    write a synthetic level to basedir.
+    drift: standard deviation of the movement of the whole image per time (pixels).
+    division: a cell of pages page-1 ~ page+1 splits into two cells moving apart from a time on.
+    return list of (time, page, x, y) of the divisions.
+    """
+    rng = np.random.RandomState(seed)
+    cell_arr = rng.uniform(80, 400, (numCell, 3))  # x, y, page
+    cell_arr[:, 2] = rng.uniform(1, pagemax, numCell)
+    radius_arr = rng.uniform(6, 11, numCell)
+    wobble_arr = rng.uniform(0, 2 * np.pi, numCell)
+    drift_arr = np.cumsum(rng.normal(0, drift, (timemax + 1, 2)), axis=0)
+    drift_arr = np.clip(drift_arr - drift_arr[1], -60, 60)
+
+    division_lst = []
+    for cell in rng.choice(numCell, min(numDivision, numCell), replace=False):
+        division_lst.append((int(rng.randint(1, max(2, timemax - 3))), int(round(cell_arr[cell][2])), cell))
+
+    os.makedirs(basedir + "/Eva_Data{0:02d}".format(level), exist_ok=True)
+    with open(basedir + "/Eva_Data{0:02d}/input.csv".format(level), "w") as f:
+        f.write("synthetic\n{}\n{}\n".format(timemax, pagemax))
+
+    for time in range(1, timemax + 1):
+        dirpath = basedir + "/Pre_Data{0:02d}/t{1:03d}".format(level, time)
+        os.makedirs(dirpath, exist_ok=True)
+        for page in range(1, pagemax + 1):
+            img = np.full((480, 480), 40, np.float32)
+            for cell, (x, y, z) in enumerate(cell_arr):
+                if abs(z - page) > 1.5:
+                    continue
+                x += drift_arr[time][0] + 2 * np.sin(time / 3 + wobble_arr[cell])
+                y += drift_arr[time][1] + 2 * np.cos(time / 3 + wobble_arr[cell])
+                center_lst = [(x, y)]
+                for divisionTime, divisionPage, divisionCell in division_lst:
+                    if divisionCell == cell and time >= divisionTime:
+                        split = min(3 * (time - divisionTime), 15)
+                        center_lst = [(x - split, y), (x + split, y)]
+                for cx, cy in center_lst:
+                    cv2.circle(img, (int(cx), int(cy)), int(radius_arr[cell]), 200, -1)
+            img = cv2.GaussianBlur(img, (7, 7), 0) + rng.normal(0, 8, img.shape)
+            img = np.clip(img, 0, 255).astype(np.uint8)
+            cv2.imwrite(dirpath + "/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page),
+                        cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))
+    return [(divisionTime, divisionPage, cell_arr[cell][0], cell_arr[cell][1])
+            for divisionTime, divisionPage, cell in division_lst]
+
+def make_config(configFilepath, basedir, benchmarkConfigFilepath):
+    config = ciputil.set_config(configFilepath)
+    config["DEFAULT"]["BASEDIR"] = basedir
+    config["DEFAULT"]["OUTPUT_VIDEO"] = "no"
+    config["CACHE"]["MEMMAP"] = "no"
+    with open(benchmarkConfigFilepath, "w") as f:
+        config.write(f)
+
+def measure(func, *args):
+    """
+    return result of func(*args), wall time, CPU time, peak RSS (MB) during func
+    """
+    instrument.reset_peak_rss()
+    startWall = time.perf_counter()
+    startCpu = time.process_time()
+    result = func(*args)
+    return result, time.perf_counter() - startWall, time.process_time() - startCpu, instrument.get_peak_rss()
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scale(timemax, pagemax, dirpath, configFilepath, seed, reference):
+    """
+    benchmark the stages on a synthetic level of timemax x pagemax.
+    return list of records (stage, wall_s, cpu_s, peak_rss_mb, frames, ...)
+    """
+    basedir = dirpath + "/data_{}x{}_{}".format(timemax, pagemax, seed)
+    if not os.path.exists(basedir + "/Eva_Data{0:02d}/input.csv".format(LEVEL)):
+        print("START: make synthetic stack {}".format(basedir))
+        make_stack(basedir, LEVEL, timemax, pagemax, seed=seed)
+    benchmarkConfigFilepath = basedir + "/config.ini"
+    make_config(configFilepath, basedir, benchmarkConfigFilepath)
+
+    TIME_MAX, PAGE_MAX, _ = ciputil.read_config(benchmarkConfigFilepath, LEVEL)
+    ciputil.imageCache_dct.clear()
+    angleThresh, _, _ = ciputil.read_config_stabilize(benchmarkConfigFilepath)
+    _, windowSize, _, _, interpolation, _, _, flowThreads = ciputil.read_config_cumulative(benchmarkConfigFilepath)
+    _, dotWindowSize, flowThreshold, dotThreshold, _, _, batchSize, tileSize = ciputil.read_config_dot(benchmarkConfigFilepath)
+    _, _, backend, eps, minSamples = ciputil.read_config_detect(benchmarkConfigFilepath)
+    stabilize.TIME_MAX, stabilize.PAGE_MAX = TIME_MAX, PAGE_MAX
+    cumulative_flow.TIME_MAX, cumulative_flow.PAGE_MAX, cumulative_flow.PAGE = TIME_MAX, PAGE_MAX, 1
+    cumulative_flow.FLOW_THREADS = flowThreads
+    dot_product.TIME_MAX, dot_product.PAGE = TIME_MAX, 1
+
+    record_lst = []
+    def add(stage, frames, wall, cpu, peakRss, **info):
+        record = {"stage": stage, "timemax": TIME_MAX, "pagemax": PAGE_MAX, "wall_s": wall, "cpu_s": cpu,
+                  "peak_rss_mb": peakRss, "frames": frames, "frames_per_s": frames / wall if wall > 0 else 0}
+        record.update(info)
+        record_lst.append(record)
+        print("DONE: {} {}x{}, {:.2f} sec, {:.1f} MB".format(stage, TIME_MAX, PAGE_MAX, wall, peakRss))
+
+    fixDirection_arr, *stat = measure(stabilize.calc_fix_direction, angleThresh)
+    add("stabilize", TIME_MAX * PAGE_MAX, *stat)
+    fixDirection_arr = np.clip(fixDirection_arr, -240, 240)
+
+    flow_arr, *stat = measure(cumulative_flow.calc_stabilized_flows, fixDirection_arr)
+    add("stabilized_flows", TIME_MAX, *stat)
+
+    cmlFlow_arr, *stat = measure(cumulative_flow.calc_cumulative_flows_vectorized, flow_arr, windowSize, fixDirection_arr, interpolation)
+    add("cumulative_flows", TIME_MAX, *stat)
+    if reference:
+        _, *stat = measure(cumulative_flow.calc_cumulative_flows_fast, flow_arr, windowSize, fixDirection_arr)
+        add("cumulative_flows_fast", TIME_MAX, *stat)
+    del flow_arr
+
+    region = ciputil.get_stabilized_region(fixDirection_arr, 1, TIME_MAX)
+    dotProduct_arr, *stat = measure(dot_product.calc_dot_product, cmlFlow_arr, dotWindowSize, flowThreshold, region, batchSize, tileSize)
+    add("dot_product", TIME_MAX, *stat)
+    del cmlFlow_arr
+
+    #candidates of page 1, put on every page so that the table grows with PAGE_MAX
+    point_lst = [np.nonzero(dotProduct_arr[time] < dotThreshold) for time in range(1, TIME_MAX + 1)]
+    count_arr = np.array([len(x_arr) for x_arr, _ in point_lst])
+    x_arr = np.tile(np.concatenate([x_arr for x_arr, _ in point_lst]), PAGE_MAX)
+    y_arr = np.tile(np.concatenate([y_arr for _, y_arr in point_lst]), PAGE_MAX)
+    time_arr = np.tile(np.repeat(np.arange(1, TIME_MAX + 1), count_arr), PAGE_MAX)
+    page_arr = np.repeat(np.arange(1, PAGE_MAX + 1), count_arr.sum())
+    import pandas as pd
+    df = pd.DataFrame({"x": x_arr, "y": y_arr, "time": time_arr, "page": page_arr})
+    _, *stat = measure(detect.classify, df, backend, eps, minSamples)
+    add("classify", TIME_MAX * PAGE_MAX, *stat, points=len(df), backend=backend)
+    return record_lst
+
+def run_startup(repeat):
+    """
+    time the startup (interpreter and import) of each entry point in new processes.
+    return list of records (stage, wall_s, cpu_s, peak_rss_mb, modules)
+    """
+    dirpath = os.path.dirname(os.path.abspath(__file__))
+    record_lst = []
+    for module in ENTRY_POINTS:
+        wall_lst, cpu_lst = [], []
+        for _ in range(repeat):
+            startCpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+            startWall = time.perf_counter()
+            output = subprocess.check_output([sys.executable, "-c", STARTUP_CODE.format(module=module, heavy=HEAVY_MODULES)], cwd=dirpath)
+            wall_lst.append(time.perf_counter() - startWall)
+            endCpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_lst.append(endCpu.ru_utime + endCpu.ru_stime - startCpu.ru_utime - startCpu.ru_stime)
+        peakRss, module_lst = json.loads(output.decode().strip().splitlines()[-1])
+        record_lst.append({"stage": "startup_" + module, "timemax": None, "pagemax": None, "wall_s": float(np.median(wall_lst)),
+                           "cpu_s": float(np.median(cpu_lst)), "peak_rss_mb": peakRss, "repeat": repeat, "modules": module_lst})
+        print("DONE: startup {}, {:.3f} sec, {:.1f} MB, heavy modules = {}".format(module, np.median(wall_lst), peakRss, module_lst))
+    return record_lst
+
+def read_results(resultsFilepath):
+    if not os.path.exists(resultsFilepath):
+        return []
+    with open(resultsFilepath, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(record_lst, previous_lst):
+    """
+    print the change of wall time and peak RSS from the latest previous result of the same stage and scale
+    """
+    latest_dct = {}
+    for record in previous_lst:
+        latest_dct[(record["stage"], record["timemax"], record["pagemax"])] = record
+    print("\n{:<24} {:>8} {:>10} {:>10} {:>12} {:>10}".format("stage", "scale", "wall_s", "change", "peak_rss_mb", "change"))
+    for record in record_lst:
+        previous = latest_dct.get((record["stage"], record["timemax"], record["pagemax"]))
+        scale = "-" if record["timemax"] is None else "{}x{}".format(record["timemax"], record["pagemax"])
+        if previous is None:
+            wallChange, rssChange = "-", "-"
+        else:
+            wallChange = "{:+.1f}%".format(100 * (record["wall_s"] / previous["wall_s"] - 1))
+            rssChange = "{:+.1f}%".format(100 * (record["peak_rss_mb"] / previous["peak_rss_mb"] - 1))
+        print("{:<24} {:>8} {:>10.2f} {:>10} {:>12.1f} {:>10}".format(
+            record["stage"], scale, record["wall_s"], wallChange, record["peak_rss_mb"], rssChange))
+
+def main(scale_lst, dirpath, resultsFilepath, seed=0, reference=False, startup=0, configFilepath="./config/config.ini"):
+    """
+    startup: if > 0, time the startup of the entry points (startup runs each) instead of the stages
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    os.makedirs(os.path.dirname(resultsFilepath) or ".", exist_ok=True)
+    previous_lst = read_results(resultsFilepath)
+    run = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "revision": git_revision(), "seed": seed}
+
+    record_lst = []
+    if startup > 0:
+        record_lst += run_startup(startup)
+    for timemax, pagemax in ([] if startup > 0 else scale_lst):
+        record_lst += run_scale(timemax, pagemax, dirpath, configFilepath, seed, reference)
+    with open(resultsFilepath, "a") as f:
+        for record in record_lst:
+            record.update(run)
+            f.write(json.dumps(record) + "\n")
+    compare(record_lst, previous_lst)
+    print("DONE: results are appended to {}".format(resultsFilepath))
+
+def parse_scale(text):
+    timemax, pagemax = text.lower().split("x")
+    return int(timemax), int(pagemax)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="benchmark of the stages on synthetic image stacks")
+    parser.add_argument("--scale", nargs="+", type=parse_scale, default=[(6, 3), (12, 4)], help="TIME_MAXxPAGE_MAX")
+    parser.add_argument("--dirpath", default="./out/benchmark", help="directory of the synthetic stacks")
+    parser.add_argument("--results", default="./out/benchmark/results.jsonl", help="results file (JSON lines)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic stacks")
+    parser.add_argument("--reference", action="store_true", help="also time calc_cumulative_flows_fast")
+    parser.add_argument("--startup", action="store_true", help="time the startup of the entry points instead of the stages")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each entry point with --startup")
+    args = parser.parse_args()
+    main(args.scale, args.dirpath, args.results, args.seed, args.reference, args.repeat if args.startup else 0)
@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+fused cumulative_flow -> dot_product -> candidate stage for a page.
+each cmlFlow_arr[time] is taken as soon as stream_cumulative_flows produces it, BATCH_SIZE frames of dot products
+are calculated on the stabilized region, and the points under [DETECT] DOT_THRESHOLD go to
+./out/{level}_cand_{page}.npy, which detect.get_df reads instead of the dot products.
+cmlFlow_arr and dotProduct_arr are never written (unless DUMP_INTERMEDIATE), so no large file is written or read again.
+the values are rounded to [STORE] DTYPE like the stores of the separate stages, so the candidates are the same.
+
+the candidate file is candidate_arr[3][points] (int16): x, y and time of each point, in the order of detect.find_below.
+
+configure [CANDIDATES] section in "config/config.ini". [CUMULATIVE], [DOT], [DETECT] DOT_THRESHOLD and [STORE] are used as well.
+    FUSED             : If yes, pipeline.py runs this stage instead of cumulative_flow and dot_product,
+                        and detect.py reads the candidates.
+    DUMP_INTERMEDIATE : If yes, cmlFlow_arr and dotProduct_arr are also dumped as by the separate stages (for debugging and videos).
+"""
+
+import sys
+import time
+import numpy as np
+
+import ciputil
+import flowstore
+import instrument
+import cumulative_flow
+import dot_product
+
+TIME_MAX = None
+PAGE_MAX = None
+
+
+def as_stored(arr, storeDtype):
+    """
+    values of arr as read back from a store of storeDtype
+    """
+    return np.asarray(arr, storeDtype)
+
+def find_candidates(dot, time, dotThreshold, region):
+    """
+    return candidate_arr[3][points] (x, y, time) of a frame of dot products dot[height][width] on region
+    """
+    top, left, height, width = region
+    if dotThreshold > 0:
+        #zero outside region is also under dotThreshold
+        dot = ciputil.expand_to_canvas(dot, region)
+        top, left = 0, 0
+    x_arr, y_arr = np.nonzero(dot < dotThreshold)
+    return np.array([x_arr + top, y_arr + left, np.full(len(x_arr), time)], np.int16)
+
+@instrument.measured("candidates")
+def run_page(level, page, configFilepath="./config/config.ini"):
+    """
+    calculate and dump the candidates of a page.
+    return filepath of the dumped candidate_arr.
+    """
+    global TIME_MAX
+    global PAGE_MAX
+
+    TIME_MAX, PAGE_MAX, _ = ciputil.read_config(configFilepath, level)
+    _, windowSize, _, _, interpolation, _, reducedGrid, flowThreads = ciputil.read_config_cumulative(configFilepath)
+    _, dotWindowSize, flowThreshold, _, _, _, batchSize, tileSize = ciputil.read_config_dot(configFilepath)
+    dotThreshold, _, _, _, _ = ciputil.read_config_detect(configFilepath)
+    _, dumpIntermediate = ciputil.read_config_candidates(configFilepath)
+    storeFormat, storeDtype, storeCrop = ciputil.read_config_store(configFilepath)
+
+    _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
+    fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+    fixDirection_arr = np.load(fixDirectionFilepath)
+    fixDirection_arr = np.clip(fixDirection_arr, -ciputil.MAX_SHIFT, ciputil.MAX_SHIFT)  #same rounding as get_stabilized_image
+
+    cumulative_flow.TIME_MAX, cumulative_flow.PAGE_MAX, cumulative_flow.PAGE = TIME_MAX, PAGE_MAX, page
+    cumulative_flow.FLOW_THREADS = flowThreads
+    #cumulative flows on cmlRegion, dot products on region (as cumulative_flow.run_page and dot_product.run_page)
+    region = ciputil.get_stabilized_region(fixDirection_arr, page, TIME_MAX)
+    cmlRegion = region if reducedGrid else ciputil.CANVAS_REGION
+    top, left, height, width = region
+    cropTop, cropLeft = top - cmlRegion[0], left - cmlRegion[1]
+    instrument.add_work(TIME_MAX, TIME_MAX * height * width)
+
+    if dumpIntermediate:
+        canvasShape = (TIME_MAX + 1, ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE)
+        cmlFlow_arr = flowstore.create(ciputil.dump_filepath("cml", level, page), canvasShape + (2,), storeFormat, storeDtype, storeCrop)
+        dotProduct_arr = flowstore.create(ciputil.dump_filepath("dot", level, page), canvasShape, storeFormat, storeDtype, storeCrop)
+
+    #dot product of time = 1 is 0, as dot_product.calc_dot_product starts at time = 2
+    candidate_lst = [find_candidates(np.zeros((height, width)), 1, dotThreshold, region)]
+    def flush_batch(time_lst, cmlBatch_lst):
+        instrument.count("dot_batches")
+        #rounded to the dtype of the stores, as dot_product reads cmlFlow_arr and detect reads dotProduct_arr
+        cmlBatch_arr = as_stored(cmlBatch_lst, storeDtype).astype(np.float64)
+        if tileSize > 0:
+            dotBatch_arr = dot_product.dot_product_tiles(cmlBatch_arr, dotWindowSize, flowThreshold, tileSize)
+        else:
+            dotBatch_arr = dot_product.dot_product(cmlBatch_arr, dotWindowSize, flowThreshold)
+        dotBatch_arr = dotBatch_arr.astype(storeDtype)
+        for time, dot in zip(time_lst, dotBatch_arr):
+            candidate_lst.append(find_candidates(dot, time, dotThreshold, region))
+            if dumpIntermediate:
+                dotProduct_arr[time] = ciputil.expand_to_canvas(dot, region)
+
+    print("START: fused candidates, page = {}, windowSize = {}, dotWindowSize = {}".format(page, windowSize, dotWindowSize))
+    time_lst = []
+    cmlBatch_lst = []
+    for time, cmlFlow in cumulative_flow.stream_cumulative_flows(fixDirection_arr, windowSize, interpolation,
+                                                                 region if reducedGrid else None):
+        if dumpIntermediate:
+            cmlFlow_arr[time] = ciputil.expand_to_canvas(cmlFlow, cmlRegion) if reducedGrid else cmlFlow
+        if time == 1:
+            continue
+        time_lst.append(time)
+        cmlBatch_lst.append(cmlFlow[cropTop : cropTop + height, cropLeft : cropLeft + width])
+        if len(time_lst) == batchSize:
+            flush_batch(time_lst, cmlBatch_lst)
+            time_lst, cmlBatch_lst = [], []
+    #cmlFlow of TIME_MAX is 0 (nothing moves after the last image)
+    if TIME_MAX >= 2:
+        time_lst.append(TIME_MAX)
+        cmlBatch_lst.append(np.zeros((height, width, 2)))
+    if len(time_lst) > 0:
+        flush_batch(time_lst, cmlBatch_lst)
+    if dumpIntermediate:
+        cmlFlow_arr.flush()
+        dotProduct_arr.flush()
+
+    candidate_arr = np.concatenate(candidate_lst, axis=1)
+    dumpFilepath = ciputil.dump_filepath("cand", level, page)
+    np.save(dumpFilepath, candidate_arr)
+    print("DONE: {} candidates, dump to {}".format(candidate_arr.shape[1], dumpFilepath))
+    return dumpFilepath
+
+def main(level):
+    configFilepath = "./config/config.ini"
+    _, pageMax, _ = ciputil.read_config(configFilepath, level)
+    for page in range(1, pageMax+1):
+        run_page(level, page, configFilepath)
+
+if __name__ == "__main__":
+    start = time.time()
+    main(ciputil.get_level(sys.argv))
+    elapse = time.time() - start
+    print("\nelapse time: {} sec".format(elapse))
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+regression check of the content keys of the stages (artifact.STAGE_CONFIG).
+    every config value of STAGE_CONFIG changes the key of its stage (artifact.stage_key).
+    every value of the sections of the stages is in the key of a stage, or is known not to change any output (NEUTRAL),
+    so that a new option cannot be left out of the keys (a stage would be skipped by pipeline.py and shared by sweep.py
+    although its output changed).
+"""
+
+import sys
+
+import ciputil
+import artifact
+
+STAGE_SECTIONS = ["STABILIZE", "CUMULATIVE", "DOT", "DETECT", "FLOW", "STORE"]
+#values which change only file paths, videos, speed or memory, but not the outputs
+NEUTRAL = {
+    ("STABILIZE", "DUMP_FILEPATH"), ("STABILIZE", "VIDEO_FILEPATH"),
+    ("CUMULATIVE", "PAGE"), ("CUMULATIVE", "STREAMING"), ("CUMULATIVE", "FLOW_THREADS"),
+    ("CUMULATIVE", "DUMP_FILEPATH"), ("CUMULATIVE", "VIDEO_FILEPATH"),
+    ("DOT", "RECALCULATE"), ("DOT", "DOT_THRESHOLD"), ("DOT", "BATCH_SIZE"), ("DOT", "TILE_SIZE"),
+    ("DOT", "DUMP_FILEPATH"), ("DOT", "VIDEO_FILEPATH"),
+    ("DETECT", "ANSWER_FILEPATH"),
+}
+
+
+def main(configFilepath="./config/config.ini"):
+    ng_lst = []
+    for stage, name_lst in artifact.STAGE_CONFIG.items():
+        key = artifact.stage_key(stage, ciputil.set_config(configFilepath))
+        for section, option in name_lst:
+            config = ciputil.set_config(configFilepath)
+            config[section][option] = config[section][option] + "_changed"
+            if artifact.stage_key(stage, config) == key:
+                ng_lst.append("{}.{} does not change the key of {}".format(section, option, stage))
+
+    keyed_set = {name for name_lst in artifact.STAGE_CONFIG.values() for name in name_lst}
+    config = ciputil.set_config(configFilepath)
+    for section in STAGE_SECTIONS:
+        for option in config[section]:
+            name = (section, option.upper())
+            if option in config.defaults() or name in keyed_set or name in NEUTRAL:
+                continue
+            ng_lst.append("{}.{} is in no key".format(*name))
+
+    for ng in ng_lst:
+        print("NG: " + ng)
+    if len(ng_lst) > 0:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+regression check of the grid DBSCAN (clustering.dbscan_grid).
+compare its labels with sklearn.cluster.DBSCAN on random point sets of 2 to 4 dimensions
+(with duplicated points and small chunks), including the cluster of border points shared by clusters.
+"""
+
+import sys
+import time
+import numpy as np
+
+import clustering
+
+
+def make_points(rng):
+    """
+    return X[points][dim], eps, minSamples of a random trial: uniform noise and a few dense blobs
+    """
+    dim = rng.randint(2, 5)
+    X = rng.uniform(0, 1, (rng.randint(20, 300), dim))
+    for _ in range(rng.randint(0, 4)):
+        X = np.vstack([X, rng.normal(rng.uniform(0, 1, dim), 0.03, (rng.randint(5, 50), dim))])
+    X = np.vstack([X, X[rng.randint(0, len(X), rng.randint(0, 10))]])  # duplicated points
+    return X, rng.uniform(0.03, 0.2), rng.randint(2, 8)
+
+def main(trials=300, seed=0):
+    print("START: {} trials".format(trials))
+    start = time.time()
+    rng = np.random.RandomState(seed)
+    numDiffer = 0
+    for trial in range(trials):
+        X, eps, minSamples = make_points(rng)
+        sklearn_arr = clustering.dbscan_sklearn(X, eps, minSamples)
+        grid_arr = clustering.dbscan_grid(X, eps, minSamples, chunkSize=rng.choice([7, 100, 10**7]))
+        if not np.array_equal(sklearn_arr, grid_arr):
+            numDiffer += 1
+            print("NG: trial = {}, points = {}, eps = {}, minSamples = {}, differing labels = {}".format(
+                trial, len(X), eps, minSamples, np.sum(sklearn_arr != grid_arr)))
+    print("DONE: {} sec".format(time.time() - start))
+    if numDiffer > 0:
+        print("NG: {} of {} trials differ".format(numDiffer, trials))
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
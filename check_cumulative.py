@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+regression check of the vectorized cumulation engine.
+compare calc_cumulative_flows_vectorized with the per-pixel loop (calc_cumulative_flows)
+on a small synthetic flow stack, and its time convention with the one of calc_cumulative_flows_fast
+(cmlFlow_arr[time] cumulates the flows of time + 1 ~ time + windowSize) on translations.
+"""
+
+import sys
+import time
+import numpy as np
+
+import cumulative_flow
+
+
+def make_synthetic_flows(timeMax, seed=0):
+    """
+    return flow_arr[time+1][960][960][2] of smooth random flows, fixDirection_arr[2][time+1][3]
+    flows are zero near the image border so that every trajectory stays inside the image.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:960, 0:960] / 960.0
+    inner = np.zeros((960, 960))
+    inner[16:-16, 16:-16] = 1
+    flow_arr = np.zeros((timeMax + 1, 960, 960, 2))
+    for time in range(2, timeMax + 1):
+        phase = rng.uniform(0, 2 * np.pi, 2)
+        flow_arr[time, :, :, 0] = 3.0 * np.sin(2 * np.pi * x + phase[0]) * inner
+        flow_arr[time, :, :, 1] = 3.0 * np.cos(2 * np.pi * y + phase[1]) * inner
+    fixDirection_arr = np.zeros((2, timeMax + 1, 3))
+    fixDirection_arr[1, :, :2] = rng.randint(-20, 20, (timeMax + 1, 2))
+    return flow_arr, fixDirection_arr
+
+def make_translation_flows(timeMax, seed=0):
+    """
+    return flow_arr[time+1][960][960][2] of a different integer translation at each time, fixDirection_arr[2][time+1][3] of zeros
+    """
+    rng = np.random.RandomState(seed)
+    flow_arr = np.zeros((timeMax + 1, 960, 960, 2))
+    for time in range(2, timeMax + 1):
+        flow_arr[time] = rng.randint(1, 4, 2) * rng.choice([-1, 1], 2)
+    return flow_arr, np.zeros((2, timeMax + 1, 3))
+
+def check_time_convention(timeMax, windowSize):
+    """
+    the per-pixel loop of calc_cumulative_flows_fast (the baseline) and the vectorized engine give the same
+    cumulation at each time on the pixels where both are defined.
+    the incremental update of calc_cumulative_flows_fast is wrong along the border of the previous window,
+    so 99% of the pixels must agree (a shift of the time by one agrees nowhere, as the translation changes at each time).
+    """
+    flow_arr, fixDirection_arr = make_translation_flows(timeMax)
+    fast_arr = cumulative_flow.calc_cumulative_flows_fast(flow_arr, windowSize, fixDirection_arr)
+    vectorized_arr = cumulative_flow.calc_cumulative_flows_vectorized(flow_arr, windowSize, fixDirection_arr)
+    for time in range(1, timeMax + 1):
+        both_arr = (fast_arr[time] != 0).any(axis=2) & (vectorized_arr[time] != 0).any(axis=2)
+        if time < timeMax and both_arr.sum() < 0.5 * 360 * 360:
+            print("NG: time = {}, cumulative flows are defined on {} pixels".format(time, both_arr.sum()))
+            return False
+        agree_arr = (fast_arr[time][both_arr] == vectorized_arr[time][both_arr]).all(axis=1)
+        if len(agree_arr) > 0 and agree_arr.mean() < 0.99:
+            print("NG: time = {}, the cumulation differs from calc_cumulative_flows_fast on {:.1%} of the pixels".format(
+                time, 1 - agree_arr.mean()))
+            return False
+    if (vectorized_arr[timeMax] != 0).any():
+        print("NG: cmlFlow_arr[TIME_MAX] is not 0")
+        return False
+    return True
+
+def main(timeMax=4, windowSize=2):
+    cumulative_flow.TIME_MAX = timeMax
+    cumulative_flow.PAGE = 1
+    flow_arr, fixDirection_arr = make_synthetic_flows(timeMax)
+
+    print("START: vectorized cumulation")
+    start = time.time()
+    fastCmlFlow_arr = cumulative_flow.calc_cumulative_flows_vectorized(flow_arr, windowSize, fixDirection_arr)
+    print("DONE: {} sec".format(time.time() - start))
+
+    print("START: per-pixel cumulation")
+    start = time.time()
+    slowCmlFlow_arr = cumulative_flow.calc_cumulative_flows(flow_arr, windowSize, fixDirection_arr)
+    print("DONE: {} sec".format(time.time() - start))
+
+    #the per-pixel loop cumulates the flows of time ~ time + windowSize - 1 into cmlFlow_arr[time]
+    if not np.array_equal(fastCmlFlow_arr[1:timeMax], slowCmlFlow_arr[2:]):
+        print("NG: max difference = {}".format(np.max(np.abs(fastCmlFlow_arr[1:timeMax] - slowCmlFlow_arr[2:]))))
+        sys.exit(1)
+
+    print("START: time convention of calc_cumulative_flows_fast")
+    if not check_time_convention(timeMax, windowSize):
+        sys.exit(1)
+
+    #bilinear sampling equals nearest sampling when every flow is on the integer grid
+    intFlow_arr = np.round(flow_arr)
+    nearest_arr = cumulative_flow.calc_cumulative_flows_vectorized(intFlow_arr, windowSize, fixDirection_arr, "nearest")
+    bilinear_arr = cumulative_flow.calc_cumulative_flows_vectorized(intFlow_arr, windowSize, fixDirection_arr, "bilinear")
+    if not np.allclose(nearest_arr, bilinear_arr):
+        print("NG: bilinear sampling differs on integer flows")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+regression check of the retry of crashed workers in pipeline.py.
+the pipeline is run on a small synthetic level (see benchmark.make_stack), and a worker of a stabilize task
+and a worker of a dot task are killed once each (os._exit, as a segfault or the OOM killer does).
+a crashed worker breaks the whole pool, so the failed and the pending tasks must go to a new pool
+and the run must complete with an answer file.
+then a dot task crashing every time must fail after RETRY + 1 attempts, and the tasks running next to it
+(collateral damage of its crashes) must not count any attempt.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import ciputil
+import benchmark
+import stabilize
+import dot_product
+import pipeline
+
+LEVEL = benchmark.LEVEL
+CRASH_PAGE = 1
+
+
+def crash_once(name, runPage, level, page, configFilepath):
+    """
+    run runPage, but kill the worker the first time CRASH_PAGE is run (marked by ./out/crashed_{name})
+    """
+    markerFilepath = "./out/crashed_" + name
+    if page == CRASH_PAGE and not os.path.exists(markerFilepath):
+        open(markerFilepath, "w").close()
+        os._exit(1)
+    return runPage(level, page, configFilepath)
+
+def crash_stabilize(level, page, configFilepath):
+    return crash_once("stabilize", stabilize.calc_page_movement_worker, level, page, configFilepath)
+
+def crash_dot(level, page, configFilepath):
+    return crash_once("dot", dot_product.run_page, level, page, configFilepath)
+
+def crash_dot_always(level, page, configFilepath):
+    if page == CRASH_PAGE:
+        os._exit(1)
+    return dot_product.run_page(level, page, configFilepath)
+
+def run_scheduler(configFilepath):
+    workers, retry = ciputil.read_config_pipeline(configFilepath)
+    incremental, manifestDirpath = ciputil.read_config_incremental(configFilepath)
+    scheduler = pipeline.Scheduler([LEVEL], "stabilize", "detect", workers, retry, incremental, manifestDirpath, configFilepath)
+    scheduler.run()
+    return scheduler
+
+def main(timemax=4, pagemax=3):
+    dirpath = tempfile.mkdtemp(prefix="check_pipeline_")
+    print("START: synthetic level in {}".format(dirpath))
+    benchmark.make_stack(dirpath, LEVEL, timemax, pagemax)
+    configFilepath = dirpath + "/config.ini"
+    benchmark.make_config("./config/config.ini", dirpath, configFilepath)
+    config = ciputil.set_config(configFilepath)
+    config["PIPELINE"]["WORKERS"] = "2"
+    config["PIPELINE"]["RETRY"] = "2"
+    config["PIPELINE"]["INCREMENTAL"] = "no"
+    with open(configFilepath, "w") as f:
+        config.write(f)
+
+    #the outputs go to ./out of the synthetic level
+    os.chdir(dirpath)
+    os.makedirs("out", exist_ok=True)
+    pipeline.RUN_TASK["stabilize"] = crash_stabilize
+    pipeline.RUN_TASK["dot"] = crash_dot
+    start = time.time()
+    scheduler = run_scheduler(configFilepath)
+    print("DONE: {} sec".format(time.time() - start))
+
+    ng_lst = []
+    if len(scheduler.failed_lst) > 0:
+        ng_lst.append("failed tasks = {}".format(scheduler.failed_lst))
+    if len(scheduler.attempt_dct) > 0:
+        ng_lst.append("attempts counted for crashes of other tasks = {}".format(scheduler.attempt_dct))
+    for name in ("stabilize", "dot"):
+        if not os.path.exists("./out/crashed_" + name):
+            ng_lst.append("no worker of {} crashed".format(name))
+    if not os.path.exists(ciputil.answer_filepath(LEVEL)):
+        ng_lst.append("no answer file")
+
+    print("START: a dot task crashing every time")
+    pipeline.RUN_TASK["dot"] = crash_dot_always
+    for page in range(1, pagemax + 1):
+        os.remove(ciputil.dump_filepath("dot", LEVEL, page))
+    start = time.time()
+    scheduler = run_scheduler(configFilepath)
+    print("DONE: {} sec".format(time.time() - start))
+    crashTask = (LEVEL, "dot", CRASH_PAGE)
+    if scheduler.failed_lst != [crashTask]:
+        ng_lst.append("failed tasks = {}, expected [{}]".format(scheduler.failed_lst, crashTask))
+    if scheduler.attempt_dct != {crashTask: scheduler.retry + 1}:
+        ng_lst.append("attempts = {}, expected only {} attempts of {}".format(scheduler.attempt_dct, scheduler.retry + 1, crashTask))
+    for page in range(1, pagemax + 1):
+        if page != CRASH_PAGE and not os.path.exists(ciputil.dump_filepath("dot", LEVEL, page)):
+            ng_lst.append("dot of page {} is not done".format(page))
+    for ng in ng_lst:
+        print("NG: " + ng)
+    if len(ng_lst) > 0:
+        print("the synthetic level is left in {}".format(dirpath))
+        sys.exit(1)
+    os.chdir("/")
+    shutil.rmtree(dirpath)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
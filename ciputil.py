@@ -6,13 +6,50 @@ get original/stabilized image.
 calculate/draw density flow.
 """
 
+import os
 import sys
+import json
+from time import perf_counter
 import cv2
 import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+import instrument
+import flowbackend
+import render
+import artifact
 
 BASEDIR = None
 LEVEL = None
+TIME_MAX = None
+PAGE_MAX = None
+OUTDIR = "./out"
+FLOW_BACKEND = "farneback"  # dense flow backend of calc_dense_flow (see flowbackend.py), set by read_config
+VIDEO_STRIDE = 1  # every VIDEO_STRIDE-th time of the videos of the stages is rendered, set by read_config
+VIDEO_QUEUE = render.QUEUE_SIZE
+DUMPDIR_DCT = {}  # kind -> directory of the dumped arrays of kind, set by read_config (see set_dump_dirpath)
+
+#geometry at full resolution. read_config divides it by [PREVIEW] SCALE
+SCALE = 1
+IMAGE_SIZE = 480  # images are IMAGE_SIZE x IMAGE_SIZE
+CANVAS_SIZE = 960  # stabilized images are placed on a CANVAS_SIZE x CANVAS_SIZE canvas
+MAX_SHIFT = 240  # fix directions are clipped to +-MAX_SHIFT
+CANVAS_REGION = (0, 0, 960, 960)  # (top, left, height, width) of the whole stabilized canvas
+
+IMAGE_CACHE_SIZE = 0
+PREFETCH_DEPTH = 0
+PREFETCH_THREADS = 1
+imageCache_dct = OrderedDict()  # (BASEDIR, LEVEL, SCALE, time, page) -> decoded image, least recently used first
+grayMemmap_arr = None  # grayMemmap_arr[time][page] = grayscale image of LEVEL
+
+def get_level(argv, configFilepath="./config/config.ini"):
+    """
+    level given on the command line (argv[1]), or LEVEL of config
+    """
+    if len(argv) > 1:
+        return int(argv[1])
+    return int(set_config(configFilepath)["DEFAULT"]["LEVEL"])
 
 def set_config(configFilepath):
     try:
@@ -26,6 +63,8 @@ def set_config(configFilepath):
 def read_config(configFilepath, level):
     global BASEDIR
     global LEVEL
+    global TIME_MAX
+    global PAGE_MAX
 
     def get_level_configuration():
         #inputFilepath = BASEDIR + "/Pre_Data{0:02d}/input.csv".format(LEVEL)
@@ -46,34 +85,366 @@ def read_config(configFilepath, level):
     LEVEL = level
     output_video = config.getboolean("DEFAULT", "OUTPUT_VIDEO")
     timemax, pagemax = get_level_configuration()
+    TIME_MAX, PAGE_MAX = timemax, pagemax
+    set_scale(config)
+    set_dump_dirpath(config)
+    set_flow_backend(config)
+    set_video(config)
+    set_image_cache(config, timemax, pagemax)
 
     return timemax, pagemax, output_video
 
+def get_scale(config):
+    return int(config["PREVIEW"]["SCALE"])
 
-def get_image(time, page):
-    filepath = BASEDIR + "/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(LEVEL, time, page)
-    #filepath = BASEDIR + "/Eva_Data{0:02d}/t{1:03d}/Eva_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(LEVEL, time, page)
-    img = cv2.imread(filepath)
+def set_scale(config):
+    """
+    configure [PREVIEW] section.
+        SCALE : 1 for full resolution. 2 or 4 for the preview mode: images are downsampled by SCALE when they are read,
+                and every stage works on the downsampled geometry. thresholds in pixels are scaled by read_config_*,
+                detect writes the answer file in full resolution coordinates.
+                outputs go to ./out/preview{SCALE} instead of ./out (see preview_filepath).
+    """
+    global SCALE
+    global IMAGE_SIZE
+    global CANVAS_SIZE
+    global MAX_SHIFT
+    global CANVAS_REGION
+    global OUTDIR
+
+    SCALE = get_scale(config)
+    assert SCALE in (1, 2, 4)
+    IMAGE_SIZE = 480 // SCALE
+    CANVAS_SIZE = 960 // SCALE
+    MAX_SHIFT = 240 // SCALE
+    CANVAS_REGION = (0, 0, CANVAS_SIZE, CANVAS_SIZE)
+    OUTDIR = preview_filepath(config, "./out")
+    os.makedirs(OUTDIR, exist_ok=True)
+
+def preview_filepath(config, filepath):
+    """
+    filepath of an output in the preview mode: ./out/fixDir.npy -> ./out/preview2/fixDir.npy when SCALE = 2.
+    filepaths outside ./out and all filepaths at full resolution are not changed.
+    """
+    scale = get_scale(config)
+    if scale == 1 or not (filepath == "./out" or filepath.startswith("./out/")):
+        return filepath
+    return "./out/preview{}".format(scale) + filepath[len("./out"):]
+
+def set_flow_backend(config):
+    """
+    configure [FLOW] section.
+        BACKEND : dense optical flow backend (see flowbackend.py). "farneback" (reference), "dis_ultrafast", "dis_fast" or "dis_medium".
+    """
+    global FLOW_BACKEND
+
+    flowbackend.get_backend(config["FLOW"]["BACKEND"])
+    FLOW_BACKEND = config["FLOW"]["BACKEND"]
+
+def set_dump_dirpath(config):
+    """
+    arrays and answer files go to the directory of DUMP_FILEPATH (ANSWER_FILEPATH) of the stage making them,
+    so that each stage can be pointed at its own directory (see sweep.py).
+    """
+    DUMPDIR_DCT.clear()
+    DUMPDIR_DCT["cml"] = os.path.dirname(preview_filepath(config, config["CUMULATIVE"]["DUMP_FILEPATH"]))
+    DUMPDIR_DCT["dot"] = os.path.dirname(preview_filepath(config, config["DOT"]["DUMP_FILEPATH"]))
+    DUMPDIR_DCT["cand"] = DUMPDIR_DCT["dot"]  # candidates.py replaces dot_product.py
+    DUMPDIR_DCT["output"] = os.path.dirname(preview_filepath(config, config["DETECT"]["ANSWER_FILEPATH"]))
+
+def answer_filepath(level):
+    return DUMPDIR_DCT.get("output", OUTDIR) + "/output{}.csv".format(level)
+
+def set_video(config):
+    """
+    configure STRIDE and QUEUE of [VIDEO] section (the videos of the stages, see render.py).
+        STRIDE : every STRIDE-th time point is rendered (1: all), for a quick look.
+        QUEUE  : number of frames waiting for the encoder thread.
+    """
+    global VIDEO_STRIDE
+    global VIDEO_QUEUE
+
+    VIDEO_STRIDE = max(int(config["VIDEO"]["STRIDE"]), 1)
+    VIDEO_QUEUE = int(config["VIDEO"]["QUEUE"])
+
+def set_image_cache(config, timemax, pagemax):
+    """
+    configure [CACHE] section.
+        SIZE   : number of decoded images kept in memory (least recently used are dropped).
+        MEMMAP : If yes, all images of the level are decoded once into a grayscale uint8 memmap
+                 (./out/{level}_gray.npy), and get_image/get_gray_image read it instead of tif files.
+                 BASEDIR and the fingerprint of the images are kept in ./out/{level}_gray.json,
+                 and the memmap is rebuilt when they change.
+        PREFETCH         : number of images read ahead by frames/prefetch (0: no read ahead).
+        PREFETCH_THREADS : number of threads reading ahead.
+    """
+    global IMAGE_CACHE_SIZE
+    global PREFETCH_DEPTH
+    global PREFETCH_THREADS
+    global grayMemmap_arr
+
+    IMAGE_CACHE_SIZE = int(config["CACHE"]["SIZE"])
+    PREFETCH_DEPTH = int(config["CACHE"]["PREFETCH"])
+    PREFETCH_THREADS = int(config["CACHE"]["PREFETCH_THREADS"])
+    while len(imageCache_dct) > IMAGE_CACHE_SIZE:
+        imageCache_dct.popitem(last=False)
+
+    grayMemmap_arr = None
+    if config.getboolean("CACHE", "MEMMAP"):
+        memmapFilepath = dump_filepath("gray", LEVEL)
+        key = gray_memmap_key(timemax, pagemax)
+        if not os.path.exists(memmapFilepath) or read_gray_memmap_key(memmapFilepath) != key:
+            build_gray_memmap(memmapFilepath, timemax, pagemax)
+            write_gray_memmap_key(memmapFilepath, key)
+        grayMemmap_arr = np.load(memmapFilepath, mmap_mode="r")
+        assert grayMemmap_arr.shape == (timemax + 1, pagemax + 1, IMAGE_SIZE, IMAGE_SIZE)
+
+def build_gray_memmap(memmapFilepath, timemax, pagemax):
+    """
+    decode all images of LEVEL into memmapFilepath, gray_arr[time][page][IMAGE_SIZE][IMAGE_SIZE], 1 origin time/page
+    """
+    print("START: build grayscale image memmap {}".format(memmapFilepath))
+    tmpFilepath = memmapFilepath + ".{}.tmp.npy".format(os.getpid())
+    gray_arr = np.lib.format.open_memmap(tmpFilepath, mode="w+", dtype=np.uint8,
+                                         shape=(timemax + 1, pagemax + 1, IMAGE_SIZE, IMAGE_SIZE))
+    index_lst = [(time, page) for time in range(1, timemax + 1) for page in range(1, pagemax + 1)]
+    for (time, page), img in prefetch(lambda index: read_image(*index), index_lst):
+        gray_arr[time][page] = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray_arr.flush()
+    del gray_arr
+    os.replace(tmpFilepath, memmapFilepath)  #other processes never see a half-written memmap
+    print("DONE: build grayscale image memmap")
+
+def gray_memmap_key(timemax, pagemax):
+    """
+    key of the images decoded into the memmap: BASEDIR, SCALE and the path, size and modification time of every image
+    """
+    fingerprint_lst = [artifact.image_fingerprint(page, timemax) for page in range(1, pagemax + 1)]
+    return artifact.hash_values(BASEDIR, SCALE, timemax, pagemax, fingerprint_lst)
+
+def gray_memmap_key_filepath(memmapFilepath):
+    """
+    ./out/1_gray.npy -> ./out/1_gray.json
+    """
+    return os.path.splitext(memmapFilepath)[0] + ".json"
+
+def read_gray_memmap_key(memmapFilepath):
+    keyFilepath = gray_memmap_key_filepath(memmapFilepath)
+    if not os.path.exists(keyFilepath):
+        return None
+    with open(keyFilepath, "r") as f:
+        return json.load(f)["key"]
+
+def write_gray_memmap_key(memmapFilepath, key):
+    """
+    record the key of the memmap after it is built (written to a temporary file and renamed, like the memmap)
+    """
+    keyFilepath = gray_memmap_key_filepath(memmapFilepath)
+    tmpFilepath = keyFilepath + ".{}.tmp".format(os.getpid())
+    with open(tmpFilepath, "w") as f:
+        json.dump({"basedir": BASEDIR, "key": key}, f)
+    os.replace(tmpFilepath, keyFilepath)
+
+
+def dump_filepath(kind, level, page=None, dirpath=None):
+    """
+    filepath of dumped arrays, e.g. dump_filepath("cml", 1, 33) = ./out/1_cml_33.npy, dump_filepath("gray", 1) = ./out/1_gray.npy
+    the directory is dirpath, or the one of kind set by read_config.
+    """
+    dirpath = dirpath or DUMPDIR_DCT.get(kind, OUTDIR)
+    if page is None:
+        return dirpath + "/{0}_{1}.npy".format(level, kind)
+    return dirpath + "/{0}_{1}_{2}.npy".format(level, kind, page)
+
+def image_filepath(time, page):
+    return BASEDIR + "/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(LEVEL, time, page)
+    #return BASEDIR + "/Eva_Data{0:02d}/t{1:03d}/Eva_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(LEVEL, time, page)
+
+def read_image(time, page):
+    """
+    decode the tif file without cache (and downsample it in the preview mode)
+    """
+    start = perf_counter()
+    img = cv2.imread(image_filepath(time, page))
     assert img.shape == (480, 480, 3)
+    if SCALE > 1:
+        img = cv2.resize(img, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+    instrument.count("images_decoded")
+    instrument.count("decode_s", perf_counter() - start)
     return img
 
+def get_image(time, page):
+    """
+    return BGR image of (time, page). the caller may modify the returned image.
+    """
+    if grayMemmap_arr is not None:
+        return cv2.cvtColor(grayMemmap_arr[time][page], cv2.COLOR_GRAY2BGR)
+
+    key = (BASEDIR, LEVEL, SCALE, time, page)
+    if key in imageCache_dct:
+        imageCache_dct.move_to_end(key)
+        instrument.count("cache_hits")
+        return imageCache_dct[key].copy()
+    img = read_image(time, page)
+    if cache_image(key, img):
+        img = img.copy()
+    return img
+
+def cache_image(key, img):
+    """
+    put a decoded image into the cache. return True if it is cached (then it must not be modified).
+    """
+    if IMAGE_CACHE_SIZE <= 0:
+        return False
+    imageCache_dct[key] = img
+    if len(imageCache_dct) > IMAGE_CACHE_SIZE:
+        imageCache_dct.popitem(last=False)
+    return True
+
+def get_gray_image(time, page):
+    """
+    return grayscale image of (time, page)
+    """
+    if grayMemmap_arr is not None:
+        return np.array(grayMemmap_arr[time][page])
+    return cv2.cvtColor(get_image(time, page), cv2.COLOR_BGR2GRAY)
+
+def prefetch(load, key_lst, depth=None, threads=None):
+    """
+    yield (key, load(key)) in the order of key_lst.
+    the next `depth` keys are loaded in `threads` background threads (cv2.imread releases the GIL),
+    so reading and decoding hide behind the work done on the yielded values.
+    depth and threads default to [CACHE] PREFETCH and PREFETCH_THREADS.
+    """
+    depth = PREFETCH_DEPTH if depth is None else depth
+    threads = PREFETCH_THREADS if threads is None else threads
+    if depth <= 0:
+        for key in key_lst:
+            yield key, load(key)
+        return
+
+    key_iter = iter(key_lst)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for key in key_iter:
+            pending.append((key, executor.submit(load, key)))
+            if len(pending) > depth:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while len(pending) > 0:
+            key, future = pending.popleft()
+            yield key, future.result()
+    finally:
+        #the caller may stop early: drop the reads which are not started
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+def frames(level, page=None, time=None, gray=False, depth=None, stride=1):
+    """
+    scan images of level (which must be read by read_config) in order, reading the next images ahead (see prefetch).
+        for time, img in frames(level, page)       : images of a page in time order
+        for page, img in frames(level, time=time)  : images of a time in page order
+    only every stride-th image (from the first) is read.
+    images are BGR (the caller may modify them), or grayscale if gray, same as get_image/get_gray_image.
+    """
+    assert level == LEVEL, "read_config of level {} first".format(level)
+    assert (page is None) != (time is None)
+    byTime = page is not None
+    if byTime:
+        index_lst = [(time, page) for time in range(1, TIME_MAX + 1)]
+    else:
+        index_lst = [(time, page) for page in range(1, PAGE_MAX + 1)]
+    index_lst = index_lst[::stride]
+
+    def load(index):
+        """
+        return (image, True if it was decoded from the file). runs in a background thread,
+        so it only reads the cache, which is updated in the scanning thread.
+        """
+        if grayMemmap_arr is not None:
+            return np.array(grayMemmap_arr[index[0]][index[1]]), False
+        img = imageCache_dct.get((BASEDIR, LEVEL, SCALE) + index)
+        if img is not None:
+            return img, False
+        return read_image(*index), True
+
+    for (imgTime, imgPage), (img, decoded) in prefetch(load, index_lst, depth):
+        if grayMemmap_arr is not None:
+            if not gray:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        else:
+            key = (BASEDIR, LEVEL, SCALE, imgTime, imgPage)
+            if decoded:
+                cached = cache_image(key, img)
+            else:
+                cached = True
+                if key in imageCache_dct:
+                    imageCache_dct.move_to_end(key)
+                instrument.count("cache_hits")
+            if gray:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            elif cached:
+                img = img.copy()
+        yield (imgTime if byTime else imgPage), img
+
 def calc_dense_flow(prevImg, nextImg):
     if len(prevImg.shape) == 3:
         prevImg = cv2.cvtColor(prevImg, cv2.COLOR_BGR2GRAY)
     if len(nextImg.shape) == 3:
         nextImg =  cv2.cvtColor(nextImg, cv2.COLOR_BGR2GRAY)
-    return cv2.calcOpticalFlowFarneback(prevImg, nextImg, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    start = perf_counter()
+    flow = flowbackend.get_backend(FLOW_BACKEND)(prevImg, nextImg)
+    instrument.count("flows")
+    instrument.count("flow_s", perf_counter() - start)
+    return flow
+
+def iter_dense_flows(gray_iter, calcFlow, threads=1, out=None):
+    """
+    gray_iter yields (time, gray) of consecutive times (e.g. frames(level, page, gray=True)).
+    yield (time, flow) in time order for the second and later times, flow = calcFlow(time, gray of time - 1, gray of time).
+    each gray is read from gray_iter once (in this thread), and used by the two pairs it belongs to.
+    up to 2 * threads pairs are calculated in a thread pool (OpenCV releases the GIL) while the next frames are read.
+    When out is given, each flow is written to out[time] by the thread which calculated it, and out[time] is yielded.
+    """
+    def run(time, prevGray, nextGray):
+        flow = calcFlow(time, prevGray, nextGray)
+        if out is None:
+            return flow
+        out[time] = flow
+        return out[time]
+
+    gray_iter = iter(gray_iter)
+    _, prevGray = next(gray_iter)
+    if threads <= 1:
+        for time, nextGray in gray_iter:
+            yield time, run(time, prevGray, nextGray)
+            prevGray = nextGray
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for time, nextGray in gray_iter:
+            pending.append((time, executor.submit(run, time, prevGray, nextGray)))
+            prevGray = nextGray
+            while len(pending) > 2 * threads or (len(pending) > 0 and pending[0][1].done()):
+                doneTime, future = pending.popleft()
+                yield doneTime, future.result()
+        while len(pending) > 0:
+            doneTime, future = pending.popleft()
+            yield doneTime, future.result()
 
 def get_stabilized_image(img, fixDirection):
-    assert img.shape == (480, 480, 3)
+    assert img.shape == (IMAGE_SIZE, IMAGE_SIZE, 3)
     assert len(fixDirection) == 3 # x,y,z
 
-    fixImg = np.zeros((960, 960, 3), np.uint8)
+    fixImg = np.zeros((CANVAS_SIZE, CANVAS_SIZE, 3), np.uint8)
     height, width = img.shape[:2]
     fixHeight, fixWidth = fixImg.shape[:2]
     #rounding of image movement by image size
-    fixDirection[fixDirection > 240] = 240
-    fixDirection[fixDirection < -240] = -240
+    fixDirection[fixDirection > MAX_SHIFT] = MAX_SHIFT
+    fixDirection[fixDirection < -MAX_SHIFT] = -MAX_SHIFT
 
     fixDirectionX = int(fixDirection[0])
     fixDirectionY = int(fixDirection[1])
@@ -85,35 +456,114 @@ def get_stabilized_image(img, fixDirection):
            int(width + (fixWidth - width) / 2) - fixDirectionX] = img
 
     text = '[{0:03d},{1:03d},{2:03d}]'.format(fixDirectionX, fixDirectionY,fixDirectionZ)
-    cv2.putText(fixImg, text, (660, 935),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
+    cv2.putText(fixImg, text, (660 // SCALE, 935 // SCALE),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.0 / SCALE, (255, 255, 255))
     return fixImg
 
+def get_stabilized_position(fixDirection):
+    """
+    return (top, left) of the image in the stabilized canvas (see get_stabilized_image)
+    """
+    fixDirection = np.clip(fixDirection, -MAX_SHIFT, MAX_SHIFT)
+    return MAX_SHIFT - int(fixDirection[1]), MAX_SHIFT - int(fixDirection[0])
+
+def get_stabilized_region(fixDirection_arr, page, timemax):
+    """
+    return (top, left, height, width) of the canvas region covered by the stabilized images of a page.
+    every non-zero flow, cumulative flow and dot product of the page is inside this region.
+    """
+    position_arr = np.array([get_stabilized_position(fixDirection_arr[page][time]) for time in range(1, timemax + 1)])
+    top, left = np.min(position_arr, axis=0)
+    bottom, right = np.max(position_arr, axis=0) + IMAGE_SIZE
+    return int(top), int(left), int(bottom - top), int(right - left)
+
+def calc_overlap_flow(prevImg, prevFixDirection, nextImg, nextFixDirection, region):
+    """
+    dense flow between two stabilized images, calculated only on the intersection of the two images.
+    return flow[height][width][2] on region (top, left, height, width), zero outside the intersection.
+    the values are not the same as calc_dense_flow of the whole canvases, whose black border and text affect the flow.
+    """
+    regionTop, regionLeft, regionHeight, regionWidth = region
+    prevTop, prevLeft = get_stabilized_position(prevFixDirection)
+    nextTop, nextLeft = get_stabilized_position(nextFixDirection)
+    top, left = max(prevTop, nextTop), max(prevLeft, nextLeft)
+    bottom, right = min(prevTop, nextTop) + IMAGE_SIZE, min(prevLeft, nextLeft) + IMAGE_SIZE
+
+    flow = np.zeros((regionHeight, regionWidth, 2), np.float32)
+    if top >= bottom or left >= right:
+        return flow
+    prevCrop = prevImg[top - prevTop : bottom - prevTop, left - prevLeft : right - prevLeft]
+    nextCrop = nextImg[top - nextTop : bottom - nextTop, left - nextLeft : right - nextLeft]
+    flow[top - regionTop : bottom - regionTop, left - regionLeft : right - regionLeft] = calc_dense_flow(prevCrop, nextCrop)
+    return flow
+
+def expand_to_canvas(arr, region):
+    """
+    compatibility adapter: put arr[height][width][...] computed on region into the legacy canvas layout
+    """
+    top, left, height, width = region
+    assert arr.shape[:2] == (height, width)
+    canvas = np.zeros((CANVAS_SIZE, CANVAS_SIZE) + arr.shape[2:], arr.dtype)
+    canvas[top : top + height, left : left + width] = arr
+    return canvas
+
 def draw_dense_flow(img, flow, step=8):
     h, w = img.shape[:2]
     y, x = np.mgrid[step/2:h:step, step/2:w:step].reshape(2,-1).astype(int)
     fx, fy = flow[y, x].T
     lines = np.vstack([x, y, x+fx, y+fy]).T.reshape(-1, 2, 2)
     lines = np.int32(lines)
+    return render.draw_lines(img, lines, (0, 0, 255), 1)
 
-    for (x1, y1), (x2, y2) in lines:
-        cv2.line(img, (x1, y1), (x2, y2), (0, 0, 255), 1)
-    return img
+def run_pages(runPage, level, page_lst, workers, retry, configFilepath="./config/config.ini", onDone=None):
+    """
+    run runPage(level, page, configFilepath) for each page in a process pool.
+    failed pages are resubmitted (only the failed ones) up to `retry` times.
+    onDone(page, result) is called in this process as soon as a page finishes.
+    return dict of page -> returned value (dump filepath), list of pages that failed every attempt
+    """
+    result_dct = {}
+    remaining_lst = list(page_lst)
+    for attempt in range(retry + 1):
+        if len(remaining_lst) == 0:
+            break
+        if attempt > 0:
+            print("RETRY({}/{}): pages = {}".format(attempt, retry, remaining_lst))
+
+        failed_lst = []
+        #a new pool for each attempt, since a crashed worker breaks the whole pool
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            future_dct = {executor.submit(runPage, level, page, configFilepath): page for page in remaining_lst}
+            for future in as_completed(future_dct):
+                page = future_dct[future]
+                try:
+                    result_dct[page] = future.result()
+                    if onDone is not None:
+                        onDone(page, result_dct[page])
+                except Exception as e:
+                    print("FAILED: page = {}, {}".format(page, repr(e)))
+                    failed_lst.append(page)
+        remaining_lst = sorted(failed_lst)
+    return result_dct, remaining_lst
 
 def read_config_cumulative(configFilepath):
     config = set_config(configFilepath)
     page = int(config["CUMULATIVE"]["PAGE"])
     windowSize = int(config["CUMULATIVE"]["WINDOW_SIZE"])
-    dumpFilepath = config["CUMULATIVE"]["DUMP_FILEPATH"]
-    videoFilepath = config["CUMULATIVE"]["VIDEO_FILEPATH"]
+    dumpFilepath = preview_filepath(config, config["CUMULATIVE"]["DUMP_FILEPATH"])
+    videoFilepath = preview_filepath(config, config["CUMULATIVE"]["VIDEO_FILEPATH"])
+    interpolation = config["CUMULATIVE"]["INTERPOLATION"]
+    streaming = config.getboolean("CUMULATIVE", "STREAMING")
+    reducedGrid = config.getboolean("CUMULATIVE", "REDUCED_GRID")
+    flowThreads = int(config["CUMULATIVE"]["FLOW_THREADS"])
 
-    return  page, windowSize, dumpFilepath, videoFilepath
+    return  page, windowSize, dumpFilepath, videoFilepath, interpolation, streaming, reducedGrid, flowThreads
 
 def read_config_stabilize(configFilepath):
     config = set_config(configFilepath)
     angleThresh = float(config["STABILIZE"]["ANGLE_THRESH"])
-    dumpFilepath = config["STABILIZE"]["DUMP_FILEPATH"]
-    videoFilepath = config["STABILIZE"]["VIDEO_FILEPATH"]
+    dumpFilepath = preview_filepath(config, config["STABILIZE"]["DUMP_FILEPATH"])
+    videoFilepath = preview_filepath(config, config["STABILIZE"]["VIDEO_FILEPATH"])
 
     return angleThresh, dumpFilepath, videoFilepath
 
@@ -123,7 +573,68 @@ def read_config_dot(configFilepath):
     windowSize = int(config["DOT"]["WINDOW_SIZE"])
     flowThreshold = int(config["DOT"]["FLOW_THRESHOLD"])
     dotThreshold = int(config["DOT"]["DOT_THRESHOLD"])
-    dumpFilepath = config["DOT"]["DUMP_FILEPATH"]
-    videoFilepath = config["DOT"]["VIDEO_FILEPATH"]
+    dumpFilepath = preview_filepath(config, config["DOT"]["DUMP_FILEPATH"])
+    videoFilepath = preview_filepath(config, config["DOT"]["VIDEO_FILEPATH"])
+    batchSize = int(config["DOT"]["BATCH_SIZE"])
+    tileSize = int(config["DOT"]["TILE_SIZE"])
+
+    #preview: the window is in pixels (kept odd and >= 3), FLOW_THRESHOLD is a squared length and DOT_THRESHOLD a product of lengths
+    scale = get_scale(config)
+    if scale > 1:
+        windowSize = max(3, (windowSize // scale) | 1)
+        flowThreshold = flowThreshold / scale**2
+        dotThreshold = dotThreshold / scale**2
+        tileSize = tileSize // scale
+
+    return recalculate, windowSize, flowThreshold, dotThreshold, dumpFilepath, videoFilepath, batchSize, tileSize
+
+def read_config_detect(configFilepath):
+    config = set_config(configFilepath)
+    dotThreshold = int(config["DETECT"]["DOT_THRESHOLD"])
+    subsample = int(config["DETECT"]["SUBSAMPLE"])
+    backend = config["DETECT"]["CLUSTERING"]
+    eps = float(config["DETECT"]["EPS"])
+    minSamples = int(config["DETECT"]["MIN_SAMPLES"])
+
+    #preview: dot products scale as a squared length, and there are scale**2 times fewer candidate pixels
+    scale = get_scale(config)
+    if scale > 1:
+        dotThreshold = dotThreshold / scale**2
+        minSamples = max(1, minSamples // scale**2)
+
+    return dotThreshold, subsample, backend, eps, minSamples
+
+def read_config_pipeline(configFilepath):
+    config = set_config(configFilepath)
+    workers = int(config["PIPELINE"]["WORKERS"])
+    retry = int(config["PIPELINE"]["RETRY"])
+
+    return workers, retry
+
+def read_config_store(configFilepath):
+    config = set_config(configFilepath)
+    fmt = config["STORE"]["FORMAT"]
+    dtype = config["STORE"]["DTYPE"]
+    crop = config.getboolean("STORE", "CROP")
+
+    return fmt, dtype, crop
+
+def read_config_flow(configFilepath):
+    config = set_config(configFilepath)
+    backend = config["FLOW"]["BACKEND"]
+
+    return backend
+
+def read_config_candidates(configFilepath):
+    config = set_config(configFilepath)
+    fused = config.getboolean("CANDIDATES", "FUSED")
+    dumpIntermediate = config.getboolean("CANDIDATES", "DUMP_INTERMEDIATE")
+
+    return fused, dumpIntermediate
+
+def read_config_incremental(configFilepath):
+    config = set_config(configFilepath)
+    incremental = config.getboolean("PIPELINE", "INCREMENTAL")
+    manifestDirpath = preview_filepath(config, config["PIPELINE"]["MANIFEST_DIRPATH"])
 
-    return recalculate, windowSize, flowThreshold, dotThreshold, dumpFilepath, videoFilepath
+    return incremental, manifestDirpath
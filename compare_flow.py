@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+accuracy vs speed of the dense flow backends (see flowbackend.py) on a level, against the reference backend (farneback).
+    flows  : the stabilized dense flows of the sample pages are calculated with every backend on the same image pairs.
+             reported: time per flow, speedup, and the endpoint error |flow - reference flow| in pixels
+             (mean and 95th percentile) on the overlap of the two stabilized images.
+    detect : the stages are run for each backend with sweep.py (fixDir is shared), and each answer file is compared
+             with the one of the reference: number of divisions, and divisions matched with a reference division
+             (centers of their first boxes within MATCH_DISTANCE pixels, MATCH_PAGES pages and MATCH_TIMES time points).
+the results are also written to DIRPATH/compare_flow_{level}.csv.
+
+usage: ./compare_flow.py [level] [--backend BACKEND ...] [--page PAGE ...] [--dirpath DIRPATH] [--no-detect]
+"""
+
+import os
+import time
+import argparse
+from time import perf_counter
+import numpy as np
+
+import ciputil
+import flowbackend
+import sweep
+
+REFERENCE = "farneback"
+EPE_BINS = np.linspace(0, 20, 2001)  # histogram of endpoint errors (pixels), errors over 20 pixels fall in the last bin
+MATCH_DISTANCE = 25
+MATCH_PAGES = 4
+MATCH_TIMES = 5
+
+
+def overlap_mask(prevFixDirection, nextFixDirection, region):
+    """
+    return mask[height][width] on region of the intersection of two stabilized images (see ciputil.calc_overlap_flow)
+    """
+    regionTop, regionLeft, regionHeight, regionWidth = region
+    prevTop, prevLeft = ciputil.get_stabilized_position(prevFixDirection)
+    nextTop, nextLeft = ciputil.get_stabilized_position(nextFixDirection)
+    top, left = max(prevTop, nextTop), max(prevLeft, nextLeft)
+    bottom, right = min(prevTop, nextTop) + ciputil.IMAGE_SIZE, min(prevLeft, nextLeft) + ciputil.IMAGE_SIZE
+    mask = np.zeros((regionHeight, regionWidth), bool)
+    if top < bottom and left < right:
+        mask[top - regionTop : bottom - regionTop, left - regionLeft : right - regionLeft] = True
+    return mask
+
+def compare_flows(level, page_lst, backend_lst, fixDirection_arr):
+    """
+    calculate the flows of every consecutive pair of the pages with every backend.
+    return {backend: {"flows", "flow_s", "epe_mean", "epe_p95"}}
+    """
+    stat_dct = {backend: {"flows": 0, "flow_s": 0.0, "epe_sum": 0.0, "pixels": 0, "histogram": np.zeros(len(EPE_BINS) - 1)}
+                for backend in backend_lst}
+    timeMax = ciputil.TIME_MAX
+    fixDirection_arr = np.clip(fixDirection_arr, -ciputil.MAX_SHIFT, ciputil.MAX_SHIFT)
+    for page in page_lst:
+        print("START: flows of page = {}".format(page))
+        region = ciputil.get_stabilized_region(fixDirection_arr, page, timeMax)
+        gray_iter = ciputil.frames(level, page, gray=True)
+        _, prevGray = next(gray_iter)
+        for time, nextGray in gray_iter:
+            flow_dct = {}
+            for backend in backend_lst:
+                ciputil.FLOW_BACKEND = backend
+                start = perf_counter()
+                flow_dct[backend] = ciputil.calc_overlap_flow(prevGray, fixDirection_arr[page][time - 1],
+                                                              nextGray, fixDirection_arr[page][time], region)
+                stat_dct[backend]["flow_s"] += perf_counter() - start
+                stat_dct[backend]["flows"] += 1
+
+            mask = overlap_mask(fixDirection_arr[page][time - 1], fixDirection_arr[page][time], region)
+            for backend in backend_lst:
+                epe_arr = np.linalg.norm(flow_dct[backend][mask] - flow_dct[REFERENCE][mask], axis=1)
+                stat = stat_dct[backend]
+                stat["epe_sum"] += epe_arr.sum()
+                stat["pixels"] += epe_arr.size
+                stat["histogram"] += np.histogram(np.minimum(epe_arr, EPE_BINS[-1]), EPE_BINS)[0]
+            prevGray = nextGray
+
+    result_dct = {}
+    for backend, stat in stat_dct.items():
+        cumulative_arr = np.cumsum(stat["histogram"])
+        p95 = EPE_BINS[:-1][np.searchsorted(cumulative_arr, 0.95 * cumulative_arr[-1])] if stat["pixels"] > 0 else 0.0
+        result_dct[backend] = {"flows": stat["flows"], "flow_s": stat["flow_s"],
+                               "epe_mean": stat["epe_sum"] / max(stat["pixels"], 1), "epe_p95": p95}
+    return result_dct
+
+def read_answer(answerFilepath):
+    """
+    return list of (time, x, y, page) of the divisions of an answer file: center of the first box of each division
+    """
+    division_lst = []
+    with open(answerFilepath, "r") as f:
+        timeMax = int(f.readline())
+        numDivision = int(f.readline())
+        f.readline()
+        for _ in range(numDivision):
+            box_lst = [[int(value) for value in f.readline().split("\t")] for _ in range(timeMax)]
+            f.readline()
+            for time, box in enumerate(box_lst, 1):
+                if box[0] >= 0:
+                    division_lst.append((time, (box[0] + box[3]) / 2, (box[1] + box[4]) / 2, (box[2] + box[5]) / 2))
+                    break
+    return division_lst
+
+def match_divisions(division_lst, reference_lst):
+    """
+    return number of divisions matched one to one with a reference division
+    """
+    unmatched_lst = list(reference_lst)
+    matched = 0
+    for time, x, y, page in division_lst:
+        for reference in unmatched_lst:
+            refTime, refX, refY, refPage = reference
+            if (abs(time - refTime) <= MATCH_TIMES and abs(page - refPage) <= MATCH_PAGES
+                    and np.hypot(x - refX, y - refY) <= MATCH_DISTANCE):
+                unmatched_lst.remove(reference)
+                matched += 1
+                break
+    return matched
+
+def main(level, backend_lst, page_lst, dirpath, detect=True, configFilepath="./config/config.ini"):
+    backend_lst = [REFERENCE] + [backend for backend in backend_lst if backend != REFERENCE]
+    for backend in backend_lst:
+        flowbackend.get_backend(backend)
+    row_dct = {backend: {"backend": backend} for backend in backend_lst}
+
+    if detect:
+        sweepRow_lst = sweep.main(level, [(("FLOW", "BACKEND"), backend_lst)], dirpath, configFilepath)
+        answer_dct = {row["FLOW.BACKEND"]: row["answer"] for row in sweepRow_lst}
+        reference_lst = read_answer(answer_dct[REFERENCE])
+        for backend in backend_lst:
+            division_lst = read_answer(answer_dct[backend])
+            row_dct[backend].update({"divisions": len(division_lst), "matched": match_divisions(division_lst, reference_lst)})
+        fixDirectionFilepath = os.path.abspath(dirpath) + "/{0}/{1}_fixDir.npy".format(sweepRow_lst[0]["stabilize"], level)
+    else:
+        _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
+        fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+
+    _, pageMax, _ = ciputil.read_config(configFilepath, level)
+    page_lst = page_lst or [(pageMax + 1) // 2]
+    flow_dct = compare_flows(level, page_lst, backend_lst, np.load(fixDirectionFilepath))
+    for backend in backend_lst:
+        flow = flow_dct[backend]
+        row_dct[backend].update({"ms_per_flow": 1000 * flow["flow_s"] / max(flow["flows"], 1),
+                                 "speedup": flow_dct[REFERENCE]["flow_s"] / max(flow["flow_s"], 1e-9),
+                                 "epe_mean": flow["epe_mean"], "epe_p95": flow["epe_p95"]})
+
+    row_lst = [row_dct[backend] for backend in backend_lst]
+    print("{:<14} {:>12} {:>8} {:>9} {:>8} {:>9} {:>8}".format(
+        "backend", "ms/flow", "speedup", "epe_mean", "epe_p95", "divisions", "matched"))
+    for row in row_lst:
+        print("{backend:<14} {ms_per_flow:>12.2f} {speedup:>8.2f} {epe_mean:>9.3f} {epe_p95:>8.3f} {divisions:>9} {matched:>8}".format(
+            **dict({"divisions": "-", "matched": "-"}, **row)))
+    os.makedirs(dirpath, exist_ok=True)
+    resultsFilepath = dirpath + "/compare_flow_{}.csv".format(level)
+    sweep.write_results(row_lst, resultsFilepath)
+    print("DONE: results are written to {}".format(resultsFilepath))
+
+if __name__ == "__main__":
+    start = time.time()
+    parser = argparse.ArgumentParser(prog="compare_flow.py", description="accuracy vs speed of the dense flow backends")
+    parser.add_argument("level", nargs="?", type=int, help="level (default: LEVEL of config)")
+    parser.add_argument("--backend", nargs="+", default=list(flowbackend.BACKENDS), help="backends compared with {}".format(REFERENCE))
+    parser.add_argument("--page", nargs="+", type=int, help="pages whose flows are compared (default: the middle page)")
+    parser.add_argument("--dirpath", default="./out/compare_flow", help="directory of the sweep and the results")
+    parser.add_argument("--no-detect", dest="detect", action="store_false", help="compare only the flows")
+    args = parser.parse_args()
+    main(args.level or ciputil.get_level([]), args.backend, args.page, args.dirpath, args.detect)
+    elapse = time.time() - start
+    print("\nelapse time: {} sec".format(elapse))
@@ -8,39 +8,71 @@ dump numpy files of cumulative dense flow.
 configure [CUMULATIVE] section in "config/config.ini".
     PAGE           : page for which calculate cumulative flow.
     WINDOW_SIZE    : The degree of cumulation. When windowSize = 1, cumulative flow equals to usual dense flow.
-    DUMP_FILEPATH  : filepath to dump cmlFlow_arr.
+                     cmlFlow_arr[time] cumulates the flows of time + 1 ~ time + WINDOW_SIZE (movement from the image of time),
+                     as calc_cumulative_flows_fast. cmlFlow_arr[TIME_MAX] is 0.
+    INTERPOLATION  : sampling of flows along a trajectory. "nearest" (same as the per-pixel loop) or "bilinear".
+    REDUCED_GRID   : If yes, dense flows are calculated only on the overlap of the stabilized images instead of the 960x960 canvas,
+                     and cumulation works on the region covered by the page. cmlFlow_arr is dumped in the 960x960 layout.
+                     the flows differ from those of the canvas (its black border and the text overlay change the pyramid
+                     of the flow backend), so yes changes cmlFlow_arr, the dot products and the answer file. default is no.
+    FLOW_THREADS   : number of threads calculating the dense flows of a page at a time.
+    STREAMING      : If yes, dense flows are kept only for WINDOW_SIZE frames and cmlFlow_arr is written to the dump file frame by frame.
+    DUMP_FILEPATH  : cmlFlow_arr of a page is dumped to its directory as {level}_cml_{page}.npy.
     VIDEO_FILEPATH : filepath to output video. only used when DEFAULT.OUTPUT_VIDEO = yes.
 """
 
+import os
 import numpy as np
 import sys
-from matplotlib import pyplot as plt
 import cv2
 import time
 
 import ciputil
+import flowstore
+import instrument
+import render
 
 TIME_MAX = None
 PAGE_MAX = None
 PAGE = None
 
-def calc_stabilized_flows(fixDirection_arr):
+FLOW_THREADS = 1  # threads calculating dense flows of a page
+
+def iter_stabilized_flows(fixDirection_arr, region=None, out=None):
     """
-    return flow_arr[time+1][960][960][2], 1 origin time
+    yield (time, flow[960][960][2]) one by one, 2 <= time <= TIME_MAX
+    flow of time means change between (time - 1, time)
+    When region (top, left, height, width) is given, flow is calculated only on the overlap of the two
+    stabilized images and returned as flow[height][width][2] on region.
+    each frame is converted to grayscale once, and FLOW_THREADS flows are calculated at a time (see ciputil.iter_dense_flows).
     """
-    print("start calc stabilized flow with page = {}".format(PAGE))
-    flow_arr = np.zeros((TIME_MAX + 1, 960, 960, 2))#1 origin flow_arr[time] means change between (time - 1, time)
+    if region is None:
+        gray_iter = ((time, cv2.cvtColor(ciputil.get_stabilized_image(img, fixDirection_arr[PAGE][time]), cv2.COLOR_BGR2GRAY))
+                     for time, img in ciputil.frames(ciputil.LEVEL, PAGE))
 
-    prevImg = ciputil.get_image(time=1, page=PAGE)
-    prevStabImg = ciputil.get_stabilized_image(prevImg, fixDirection_arr[PAGE][1])
+        def calc_flow(time, prevGray, nextGray):
+            return ciputil.calc_dense_flow(prevGray, nextGray)
+    else:
+        gray_iter = ciputil.frames(ciputil.LEVEL, PAGE, gray=True)
 
-    for time in range(2, TIME_MAX + 1):
+        def calc_flow(time, prevGray, nextGray):
+            return ciputil.calc_overlap_flow(prevGray, fixDirection_arr[PAGE][time - 1],
+                                             nextGray, fixDirection_arr[PAGE][time], region)
+
+    for time, flow in ciputil.iter_dense_flows(gray_iter, calc_flow, FLOW_THREADS, out):
         print("time:{}".format(time))
-        nextImg = ciputil.get_image(time=time, page=PAGE)
-        nextStabImg = ciputil.get_stabilized_image(nextImg, fixDirection_arr[PAGE][time])
-        flow = ciputil.calc_dense_flow(prevStabImg, nextStabImg)
-        flow_arr[time] = flow
-        prevStabImg = nextStabImg
+        yield time, flow
+
+def calc_stabilized_flows(fixDirection_arr, region=None):
+    """
+    return flow_arr[time+1][960][960][2] (float32), 1 origin time
+    (flow_arr[time+1][height][width][2] when region is given)
+    """
+    print("start calc stabilized flow with page = {}".format(PAGE))
+    height, width = (region or ciputil.CANVAS_REGION)[2:]
+    flow_arr = np.zeros((TIME_MAX + 1, height, width, 2), np.float32)#1 origin flow_arr[time] means change between (time - 1, time)
+    for _ in iter_stabilized_flows(fixDirection_arr, region, flow_arr):
+        pass
     return flow_arr
 
 def calc_cumulative_flows(flow_arr, windowSize, fixDirection_arr):
@@ -161,12 +193,132 @@ def calc_cumulative_flows_fast(flow_arr, windowSize, fixDirection_arr):
     return cmlFlow_arr
 
 
+def make_window_mask(fixDirection_arr, flowStart, flowEnd, region=None):
+    """
+    return mask[960][960] of pixels inside the stabilized region at every time of flowStart ~ flowEnd - 1
+    (same region as np.prod(mask_arr[flowStart : flowEnd], axis=0) in calc_cumulative_flows)
+    mask is mask[height][width] on region, when region (top, left, height, width) is given.
+    """
+    top, left, height, width = region or ciputil.CANVAS_REGION
+    #the image without 60 pixels (at full resolution) along its border: 300 ~ 660 of the canvas at full resolution
+    maskFirst = ciputil.MAX_SHIFT + 60 // ciputil.SCALE
+    maskLast = ciputil.MAX_SHIFT + ciputil.IMAGE_SIZE - 60 // ciputil.SCALE
+    mask = np.ones((height, width), bool)
+    for time in range(flowStart, flowEnd):
+        fixDirectionX = int(fixDirection_arr[PAGE][time][0]) + left
+        fixDirectionY = int(fixDirection_arr[PAGE][time][1]) + top
+        timeMask = np.zeros((height, width), bool)
+        timeMask[maskFirst - fixDirectionY : maskLast - fixDirectionY, maskFirst - fixDirectionX : maskLast - fixDirectionX] = True
+        mask &= timeMask
+    return mask
+
+def sample_flow(flow, i, j, interpolation):
+    """
+    return flow values at the (i, j) positions of all trajectories, shape = (len(i), 2)
+        nearest  : flow[int(i)][int(j)], same as the per-pixel loop
+        bilinear : weighted mean of the 4 neighbor pixels
+    positions out of the image are clipped to the border.
+    """
+    height, width = flow.shape[:2]
+    if interpolation == "nearest":
+        ni = np.clip(np.trunc(i), 0, height - 1).astype(np.intp)
+        nj = np.clip(np.trunc(j), 0, width - 1).astype(np.intp)
+        return flow[ni, nj]
+    elif interpolation == "bilinear":
+        i = np.clip(i, 0, height - 1)
+        j = np.clip(j, 0, width - 1)
+        i0 = np.floor(i).astype(np.intp)
+        j0 = np.floor(j).astype(np.intp)
+        i1 = np.minimum(i0 + 1, height - 1)
+        j1 = np.minimum(j0 + 1, width - 1)
+        di = (i - i0)[:, np.newaxis]
+        dj = (j - j0)[:, np.newaxis]
+        return (flow[i0, j0] * (1 - di) * (1 - dj) + flow[i1, j0] * di * (1 - dj)
+                + flow[i0, j1] * (1 - di) * dj + flow[i1, j1] * di * dj)
+    else:
+        raise ValueError("Unknown interpolation: {}".format(interpolation))
+
+def cumulate_window(flow_lst, mask, interpolation="nearest"):
+    """
+    advance the trajectories of all masked pixels through flow_lst at once.
+    return cmlFlow[960][960][2] (zero outside mask)
+    """
+    startX_arr, startY_arr = np.nonzero(mask)
+    i = startX_arr.astype(np.float64)
+    j = startY_arr.astype(np.float64)
+    for flow in flow_lst:
+        sampled = sample_flow(flow, i, j, interpolation)
+        i = i + sampled[:, 0]
+        j = j + sampled[:, 1]
+    cmlFlow = np.zeros(mask.shape + (2,))
+    cmlFlow[startX_arr, startY_arr, 0] = i - startX_arr
+    cmlFlow[startX_arr, startY_arr, 1] = j - startY_arr
+    return cmlFlow
+
+def calc_cumulative_flows_vectorized(flow_arr, windowSize, fixDirection_arr, interpolation="nearest", region=None):
+    """
+    return cmlFlow_arr[time+1][960][960][2], 1 origin time
+    cmlFlow_arr[time] cumulates the flows of time + 1 ~ time + windowSize, the time convention of calc_cumulative_flows_fast
+    (cmlFlow_arr[time] = calc_cumulative_flows(...)[time + 1], and cmlFlow_arr[TIME_MAX] = 0),
+    but all pixel trajectories are advanced with array operations.
+    flow_arr and cmlFlow_arr are [time+1][height][width][2] on region, when region is given.
+    """
+    region = region or ciputil.CANVAS_REGION
+    assert flow_arr.shape == (TIME_MAX + 1,) + tuple(region[2:]) + (2,)
+
+    cmlFlow_arr = np.zeros(flow_arr.shape)
+    for time in range(1, TIME_MAX):
+        flowStart = time + 1
+        flowEnd = min(flowStart + windowSize, TIME_MAX + 1)
+        mask = make_window_mask(fixDirection_arr, flowStart, flowEnd, region)
+        cmlFlow_arr[time] = cumulate_window(flow_arr[flowStart : flowEnd], mask, interpolation)
+    return cmlFlow_arr
+
+def stream_cumulative_flows(fixDirection_arr, windowSize, interpolation="nearest", region=None):
+    """
+    yield (time, cmlFlow[960][960][2]) in time order, 1 <= time <= TIME_MAX - 1 (cmlFlow of TIME_MAX is 0).
+    same values as calc_cumulative_flows_vectorized(calc_stabilized_flows(fixDirection_arr), ...),
+    but dense flows are calculated on the fly into a ring buffer of windowSize frames
+    and cmlFlow of time is emitted as soon as flows of time + 1 ~ time + windowSize are ready.
+    memory does not depend on TIME_MAX.
+    cmlFlow is cmlFlow[height][width][2] on region, when region is given.
+    """
+    for _, time, cmlFlow in stream_cumulative_variants(fixDirection_arr, [(windowSize, interpolation)], region):
+        yield time, cmlFlow
+
+def stream_cumulative_variants(fixDirection_arr, variant_lst, region=None):
+    """
+    stream_cumulative_flows of several variants variant_lst[index] = (windowSize, interpolation) at once.
+    yield (index, time, cmlFlow). the dense flows are calculated once into a ring buffer of the largest windowSize,
+    and each variant cumulates its own window of it.
+    """
+    height, width = (region or ciputil.CANVAS_REGION)[2:]
+    ringSize = max(windowSize for windowSize, _ in variant_lst)
+    ring_arr = np.zeros((ringSize, height, width, 2), np.float32)
+
+    def cumulate_ring(flowStart, flowEnd, interpolation):
+        flow_lst = [ring_arr[time % ringSize] for time in range(flowStart, flowEnd)]
+        mask = make_window_mask(fixDirection_arr, flowStart, flowEnd, region or ciputil.CANVAS_REGION)
+        return cumulate_window(flow_lst, mask, interpolation)
+
+    print("start streaming stabilized flow with page = {}".format(PAGE))
+    for time, flow in iter_stabilized_flows(fixDirection_arr, region):
+        ring_arr[time % ringSize] = flow
+        for index, (windowSize, interpolation) in enumerate(variant_lst):
+            flowStart = time - windowSize + 1
+            if flowStart >= 2:
+                yield index, flowStart - 1, cumulate_ring(flowStart, time + 1, interpolation)
+
+    #windows truncated by TIME_MAX
+    for index, (windowSize, interpolation) in enumerate(variant_lst):
+        for flowStart in range(max(2, TIME_MAX - windowSize + 2), TIME_MAX + 1):
+            yield index, flowStart - 1, cumulate_ring(flowStart, TIME_MAX + 1, interpolation)
+
+
 def output_cumulative_video(cmlFlow_arr, fixDirection_arr, videoFilepath):
-    fourcc = int(cv2.VideoWriter_fourcc(*'avc1'))
-    video = cv2.VideoWriter(videoFilepath, fourcc, 5.0, (960, 960))
-    for time in range(1, TIME_MAX + 1):
+    video = render.VideoWriter(videoFilepath, 5.0, (ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE), ciputil.VIDEO_QUEUE)
+    for time, img in ciputil.frames(ciputil.LEVEL, PAGE, stride=ciputil.VIDEO_STRIDE):
         print("time:{}".format(time))
-        img = ciputil.get_image(time=time, page=PAGE)
         stabImg = ciputil.get_stabilized_image(img, fixDirection_arr[PAGE][time])
         if time < TIME_MAX:
             flowImg = ciputil.draw_dense_flow(stabImg, cmlFlow_arr[time])
@@ -175,40 +327,121 @@ def output_cumulative_video(cmlFlow_arr, fixDirection_arr, videoFilepath):
         video.write(flowImg)
     video.release()
 
-def main(level):
+@instrument.measured("cumulative")
+def run_page(level, page, configFilepath="./config/config.ini"):
+    """
+    calculate and dump cumulative flow of a page.
+    return filepath of the dumped cmlFlow_arr.
+    """
     global TIME_MAX
     global PAGE_MAX
     global PAGE
+    global FLOW_THREADS
 
-    configFilepath = "./config/config.ini"
     TIME_MAX, PAGE_MAX, outputVideo = ciputil.read_config(configFilepath, level)
-    _ ,windowSize, _, _ = ciputil.read_config_cumulative(configFilepath)
+    _ ,windowSize, _, _, interpolation, streaming, reducedGrid, FLOW_THREADS = ciputil.read_config_cumulative(configFilepath)
 
     _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
     fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
     fixDirection_arr=np.load(fixDirectionFilepath)
+    fixDirection_arr=np.clip(fixDirection_arr, -ciputil.MAX_SHIFT, ciputil.MAX_SHIFT)  #same rounding as get_stabilized_image
 
-    for page in range(1, PAGE_MAX+1):
-        PAGE = page
-        print("START: page = {}".format(page))
+    PAGE = page
+    print("START: page = {}".format(page))
+    if reducedGrid:
+        region = ciputil.get_stabilized_region(fixDirection_arr, PAGE, TIME_MAX)
+        print("reduced grid: (top, left, height, width) = {}".format(region))
+    else:
+        region = None
+    _, _, height, width = region or ciputil.CANVAS_REGION
+    instrument.add_work(TIME_MAX, TIME_MAX * height * width)
 
+    storeFormat, storeDtype, storeCrop = ciputil.read_config_store(configFilepath)
+    dumpFilepath = ciputil.dump_filepath("cml", level, page)
+    if streaming:
+        print("START: streaming cumulative flows, windowSize = {}, interpolation = {}".format(windowSize, interpolation))
+        cmlFlow_arr = flowstore.create(dumpFilepath, (TIME_MAX + 1, ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE, 2), storeFormat, storeDtype, storeCrop)
+        for time, cmlFlow in stream_cumulative_flows(fixDirection_arr, windowSize, interpolation, region):
+            if region is not None:
+                cmlFlow = ciputil.expand_to_canvas(cmlFlow, region)
+            cmlFlow_arr[time] = cmlFlow
+        cmlFlow_arr.flush()
+    else:
         print("START: calculate stabilized dense flows")
-        flow_arr = calc_stabilized_flows(fixDirection_arr)
+        flow_arr = calc_stabilized_flows(fixDirection_arr, region)
+
+        print("START: cumulating flows, windowSize = {}, interpolation = {}".format(windowSize, interpolation))
+        cmlFlow_arr = calc_cumulative_flows_vectorized(flow_arr, windowSize, fixDirection_arr, interpolation,
+                                                       region or ciputil.CANVAS_REGION)
+        if region is not None:
+            cmlFlow_arr = np.array([ciputil.expand_to_canvas(cmlFlow, region) for cmlFlow in cmlFlow_arr])
+        flowstore.save(dumpFilepath, cmlFlow_arr, storeFormat, storeDtype, storeCrop)
+    print("DONE: dump to {}".format(dumpFilepath))
+
+    if outputVideo:
+        videoFilepath=ciputil.OUTDIR + "/cml_{}.mp4".format(page)
+        print("START: output video to {}".format(videoFilepath))
+        output_cumulative_video(cmlFlow_arr, fixDirection_arr, videoFilepath)
+    return dumpFilepath
+
+def run_page_variants(level, page, configFilepath_lst):
+    """
+    run_page for configs which differ only in [CUMULATIVE] WINDOW_SIZE, INTERPOLATION, DUMP_FILEPATH and [STORE] (see sweep.py).
+    the dense flows are calculated with the config of configFilepath_lst[0] ([FLOW] BACKEND, FLOW_THREADS, REDUCED_GRID).
+    the dense flows of the page are calculated once and cumulated for every config (always streamed, no video).
+    return list of filepaths of the dumped cmlFlow_arr of the configs.
+    """
+    global TIME_MAX
+    global PAGE_MAX
+    global PAGE
+    global FLOW_THREADS
 
-        print("START: cumulating flows, windowSize = {}".format(windowSize))
-        cmlFlow_arr = calc_cumulative_flows_fast(flow_arr, windowSize, fixDirection_arr)
+    configFilepath = configFilepath_lst[0]
+    TIME_MAX, PAGE_MAX, _ = ciputil.read_config(configFilepath, level)
+    _, _, _, _, _, _, reducedGrid, FLOW_THREADS = ciputil.read_config_cumulative(configFilepath)
+    instrument.configure(configFilepath)
 
-        dumpFilepath = "./out/{0}_cml_{1}.npy".format(level, page)
-        np.save(dumpFilepath, cmlFlow_arr)
-        print("DONE: dump to {}".format(dumpFilepath))
+    _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
+    fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+    fixDirection_arr=np.load(fixDirectionFilepath)
+    fixDirection_arr=np.clip(fixDirection_arr, -ciputil.MAX_SHIFT, ciputil.MAX_SHIFT)  #same rounding as get_stabilized_image
+
+    PAGE = page
+    region = ciputil.get_stabilized_region(fixDirection_arr, PAGE, TIME_MAX) if reducedGrid else None
+    _, _, height, width = region or ciputil.CANVAS_REGION
+
+    variant_lst = []
+    cmlFlow_lst = []
+    dumpFilepath_lst = []
+    for variantConfigFilepath in configFilepath_lst:
+        _, windowSize, dumpFilepath, _, interpolation, _, _, _ = ciputil.read_config_cumulative(variantConfigFilepath)
+        storeFormat, storeDtype, storeCrop = ciputil.read_config_store(variantConfigFilepath)
+        dumpFilepath = ciputil.dump_filepath("cml", level, page, os.path.dirname(dumpFilepath))
+        variant_lst.append((windowSize, interpolation))
+        cmlFlow_lst.append(flowstore.create(dumpFilepath, (TIME_MAX + 1, ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE, 2),
+                                            storeFormat, storeDtype, storeCrop))
+        dumpFilepath_lst.append(dumpFilepath)
 
-        if outputVideo:
-            videoFilepath="./out/cml_{}.mp4".format(page)
-            print("START: output video to {}".format(videoFilepath))
-            output_cumulative_video(cmlFlow_arr, fixDirection_arr, videoFilepath)
+    print("START: page = {}, variants (windowSize, interpolation) = {}".format(page, variant_lst))
+    with instrument.measure("cumulative", level, page):
+        instrument.add_work(TIME_MAX, TIME_MAX * height * width)
+        for index, time, cmlFlow in stream_cumulative_variants(fixDirection_arr, variant_lst, region):
+            if region is not None:
+                cmlFlow = ciputil.expand_to_canvas(cmlFlow, region)
+            cmlFlow_lst[index][time] = cmlFlow
+        for cmlFlow_arr in cmlFlow_lst:
+            cmlFlow_arr.flush()
+    print("DONE: dump to {}".format(dumpFilepath_lst))
+    return dumpFilepath_lst
+
+def main(level):
+    configFilepath = "./config/config.ini"
+    _, pageMax, _ = ciputil.read_config(configFilepath, level)
+    for page in range(1, pageMax+1):
+        run_page(level, page, configFilepath)
 
 if __name__=="__main__":
     start = time.time()
-    main()
+    main(ciputil.get_level(sys.argv))
     elapse = time.time() - start
     print('\nelapse time: {}  sec'.format(elapse))
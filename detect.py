@@ -3,120 +3,170 @@
 
 """
 output answer file(.csv). using DBSCAN clustering algorithm.
+
+configure [DETECT] section in "config/config.ini".
+    DOT_THRESHOLD   : pixels with dot product under DOT_THRESHOLD are candidates of division.
+    SUBSAMPLE       : every SUBSAMPLE-th candidate is clustered.
+    CLUSTERING      : clustering backend (see clustering.py). "dbscan" (sklearn, default) or "grid" (slower, but bounded memory, for SUBSAMPLE = 1).
+    EPS             : eps of DBSCAN in the normalized (time/400, page/260, x/960, y/960) space (x and y are divided by the canvas size).
+    MIN_SAMPLES     : min_samples of DBSCAN.
+    ANSWER_FILEPATH : the answer file of level is written to its directory as output{level}.csv.
+if [CANDIDATES] FUSED, the candidate points dumped by candidates.py are read instead of the dot products.
 """
 
 import numpy as np
 import ciputil
-import matplotlib.pyplot as plt
-import pandas as pd
-import cv2
+import flowstore
+import clustering
+import instrument
 import time
-
-from sklearn.cluster import DBSCAN
+import sys
 
 TIME_MAX=None
 PAGE_MAX=None
 
-def get_df(dotThreshold, level):
-    print("START: load dot")
-
-    dct_lst=[]
+def find_below(dotProduct_arr, time, dotThreshold):
+    """
+    return (x_arr, y_arr) of pixels whose dot product of time is under dotThreshold.
+    for a flowstore, only the stored crop of the frame is read (outside it the dot product is 0).
+    """
+    if isinstance(dotProduct_arr, flowstore.FlowStore) and dotThreshold <= 0:
+        crop, (top, left) = dotProduct_arr.get_crop(time)
+        instrument.add_work(1, crop.size)
+        x_arr, y_arr = np.nonzero(crop < dotThreshold)
+        return x_arr + top, y_arr + left
+    frame = dotProduct_arr[time]
+    instrument.add_work(1, frame.size)
+    return np.nonzero(frame < dotThreshold)
+
+def load_points(dotThreshold, level, page, fused=False):
+    """
+    return (x_arr, y_arr, time_arr) of the candidate points of a page, read from the dot products
+    or (fused) from the candidates dumped by candidates.py (same points in the same order).
+    """
+    if fused:
+        x_arr, y_arr, time_arr = np.load(ciputil.dump_filepath("cand", level, page)).astype(np.int64)
+        instrument.add_work(TIME_MAX, len(x_arr))
+        return x_arr, y_arr, time_arr
+    dotProduct_arr = flowstore.load(ciputil.dump_filepath("dot", level, page))
+    point_lst = [find_below(dotProduct_arr, time, dotThreshold) for time in range(1, TIME_MAX+1)]
+    count_arr = np.array([len(x_arr) for x_arr, _ in point_lst])
+    x_arr = np.concatenate([x_arr for x_arr, _ in point_lst])
+    y_arr = np.concatenate([y_arr for _, y_arr in point_lst])
+    return x_arr, y_arr, np.repeat(np.arange(1, TIME_MAX+1), count_arr)
+
+def get_df(dotThreshold, level, subsample=1, fused=False):
+    """
+    return DataFrame of candidate points (x, y, time, page) whose dot product is under dotThreshold.
+    at most TIME_MAX*250 points (drawn at random) are kept for each page,
+    and every subsample-th point of all pages is kept (same as df[::subsample]).
+    pages are loaded one at a time and points go straight into preallocated integer columns.
+    """
+    import pandas as pd  # only detect needs pandas, so the other stages start without it
+    print("START: load {}".format("candidates" if fused else "dot"))
+
+    pageLimit = TIME_MAX*250 // ciputil.SCALE**2
+    capacity = PAGE_MAX * (pageLimit // subsample + 1)
+    column_dct = {name: np.empty(capacity, np.int32) for name in ("x", "y", "time", "page")}
+    numPoint = 0 #number of points before subsampling
+    numKeep = 0
     for page in range(1,PAGE_MAX+1):
-        dctPage_lst=[]
-        dotFilepath="./out/{}_dot_{}.npy".format(level, page)
-        #dotFilepath="./out/dot_{}.npy".format(page)
-        dotProduct_arr = np.load(dotFilepath)
-        for time in range(1, TIME_MAX+1):
-            divisionPoint_arr = np.array(np.where(dotProduct_arr[time] < dotThreshold)).T.reshape(-1,2)
-            #print("loading {} points".format(divisionPoint_arr.shape[0]))
-            for x, y in divisionPoint_arr:
-                dct={}
-                dct["x"]=x
-                dct["y"]=y
-                dct["time"]=time
-                dct["page"]=page
-                dctPage_lst.append(dct)
-        if len(dctPage_lst) > TIME_MAX*250:
-            dctPage_lst = list(np.random.choice(dctPage_lst, TIME_MAX*250))
-        dct_lst.extend(dctPage_lst)
-    df=pd.DataFrame(dct_lst)
+        x_arr, y_arr, time_arr = load_points(dotThreshold, level, page, fused)
+        if len(x_arr) > pageLimit:
+            index_arr = np.random.choice(len(x_arr), pageLimit)
+            x_arr, y_arr, time_arr = x_arr[index_arr], y_arr[index_arr], time_arr[index_arr]
+
+        first = (-numPoint) % subsample
+        numPoint += len(x_arr)
+        x_arr, y_arr, time_arr = x_arr[first::subsample], y_arr[first::subsample], time_arr[first::subsample]
+        column_dct["x"][numKeep : numKeep + len(x_arr)] = x_arr
+        column_dct["y"][numKeep : numKeep + len(x_arr)] = y_arr
+        column_dct["time"][numKeep : numKeep + len(x_arr)] = time_arr
+        column_dct["page"][numKeep : numKeep + len(x_arr)] = page
+        numKeep += len(x_arr)
+
+    df=pd.DataFrame({name: column[:numKeep] for name, column in column_dct.items()})
     return df
 
-def classify(df):
-    print("START: classification")
+def classify(df, backend="dbscan", eps=0.02, minSamples=100):
+    import pandas as pd
+    print("START: classification, backend = {}".format(backend))
 
     norm_df=pd.DataFrame(index=df.index)
     norm_df["time"]=df["time"]/400
     norm_df["page"]=df["page"]/260
-    norm_df["x"]=df["x"]/960
-    norm_df["y"]=df["y"]/960
+    norm_df["x"]=df["x"]/ciputil.CANVAS_SIZE
+    norm_df["y"]=df["y"]/ciputil.CANVAS_SIZE
 
-    dbscan = DBSCAN(eps=0.02,min_samples=100).fit(norm_df)
-    df["label"]=dbscan.labels_
+    instrument.count("points", len(df))
+    df["label"]=clustering.get_backend(backend)(norm_df.values, eps, minSamples)
     unique, counts = np.unique(df["label"], return_counts=True)
     print(dict(zip(unique, counts)))
     return df
 
 def output(df, fixDirection_arr, outputFilepath):
-    numDetect=np.max(df["label"])+1
+    """
+    write the answer file. clusters living longer than 10 time points are divisions.
+    the stats of all labels are computed in one groupby, the boxes of every (division, time)
+    with array arithmetic, and the file is written at once.
+    """
     cellHeight=8
     cellWidth=50
 
+    stat_df = df[df["label"] >= 0].groupby("label").agg(
+        mx=("x", "mean"), my=("y", "mean"), mz=("page", "mean"), tf=("time", "min"), tl=("time", "max"))
+    stat_df = stat_df[stat_df["tl"] - stat_df["tf"] > 10]
+
+    #box_arr[division][time - 1] = ax, ay, az, bx, by, bz
+    time_arr = np.arange(1, TIME_MAX+1)
+    mx = stat_df["mx"].values[:, None]
+    my = stat_df["my"].values[:, None]
+    mz = stat_df["mz"].values[:, None]
+    fix_arr = fixDirection_arr[mz.astype(int), time_arr] #[division][time][3]
+    box_arr = np.empty((len(stat_df), TIME_MAX, 6), np.int64)
+    box_arr[:, :, 0] = np.maximum(0, (my - cellWidth/2 + fix_arr[:, :, 0] - 240).astype(np.int64))
+    box_arr[:, :, 1] = np.maximum(0, (mx - cellWidth/2 + fix_arr[:, :, 1] - 240).astype(np.int64))
+    box_arr[:, :, 2] = np.maximum(0, (mz - cellHeight/2).astype(np.int64))
+    box_arr[:, :, 3] = np.minimum(480, (my + cellWidth/2 + fix_arr[:, :, 0] - 240).astype(np.int64))
+    box_arr[:, :, 4] = np.minimum(480, (mx + cellWidth/2 + fix_arr[:, :, 1] - 240).astype(np.int64))
+    box_arr[:, :, 5] = np.minimum(PAGE_MAX, (mz + cellHeight/2).astype(np.int64))
+    alive_arr = (stat_df["tf"].values[:, None] <= time_arr) & (time_arr < stat_df["tl"].values[:, None])
+    box_arr[~alive_arr] = -1
+
+    division = ("{}\t{}\t{}\t{}\t{}\t{}\n" * TIME_MAX) + "\n"
+    text = "{}\n{}\n\n".format(TIME_MAX, len(stat_df))
+    text += "".join([division.format(*box.ravel().tolist()) for box in box_arr])
     with open(outputFilepath, "w") as f:
-        divisionLabel_lst=[]
-        for label in range(numDetect):
-            filter_df=df[df["label"]==label]
-            tf=np.min(filter_df["time"]) #time first
-            tl=np.max(filter_df["time"])
-            if tl - tf > 10:
-                divisionLabel_lst.append(label)
-
-        f.write("{}\n".format(TIME_MAX))
-        f.write("{}\n".format(len(divisionLabel_lst)))
-        f.write("\n")
-
-        for label in divisionLabel_lst:
-            filter_df=df[df["label"]==label]
-            mx=np.mean(filter_df["x"])
-            my=np.mean(filter_df["y"])
-            mz=np.mean(filter_df["page"])
-            tf=np.min(filter_df["time"]) #time first
-            tl=np.max(filter_df["time"])
-
-            for time in range(1, TIME_MAX+1):
-                if tf<=time<tl:
-                    ax=max(0, int(my-cellWidth/2+fixDirection_arr[int(mz)][time][0]-240))
-                    ay=max(0, int(mx-cellWidth/2+fixDirection_arr[int(mz)][time][1]-240))
-                    az=max(0, int(mz - cellHeight/2))
-                    bx=min(480, int(my+cellWidth/2+fixDirection_arr[int(mz)][time][0]-240))
-                    by=min(480, int(mx+cellWidth/2+fixDirection_arr[int(mz)][time][1]-240))
-                    bz=min(PAGE_MAX, int(mz + cellHeight/2))
-                else:
-                    ax,ay,az,bx,by,bz=-1,-1,-1,-1,-1,-1
-                f.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(ax,ay,az,bx,by,bz))
-            f.write("\n")
-
-def main(level):
+        f.write(text)
+
+def main(level, configFilepath="./config/config.ini"):
     global TIME_MAX
     global PAGE_MAX
 
-    configFilepath = "./config/config.ini"
     TIME_MAX, PAGE_MAX, OUTPUT_VIDEO = ciputil.read_config(configFilepath,level)
-    #_, _, _ , dotThreshold, _, _ = ciputil.read_config_dot(configFilepath)
-    dotThreshold=-10
-    df=get_df(dotThreshold, level)
-    df=df[::10]
-    df=classify(df)
+    dotThreshold, subsample, backend, eps, minSamples = ciputil.read_config_detect(configFilepath)
+    fused, _ = ciputil.read_config_candidates(configFilepath)
+    instrument.configure(configFilepath)
+    with instrument.measure("detect_load", level):
+        df=get_df(dotThreshold, level, subsample, fused)
+    with instrument.measure("classify", level):
+        df=classify(df, backend, eps, minSamples)
 
     _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
     fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
     print(fixDirectionFilepath)
     fixDirection_arr = np.load(fixDirectionFilepath)
+    if ciputil.SCALE > 1:
+        #preview: back to full resolution coordinates (center of the downsampled pixel) for the answer file
+        df["x"] = df["x"] * ciputil.SCALE + (ciputil.SCALE - 1) / 2
+        df["y"] = df["y"] * ciputil.SCALE + (ciputil.SCALE - 1) / 2
+        fixDirection_arr = fixDirection_arr * ciputil.SCALE
 
-    output(df, fixDirection_arr, "./out/output{}.csv".format(level))
+    with instrument.measure("detect_output", level):
+        output(df, fixDirection_arr, ciputil.answer_filepath(level))
 
 if __name__=="__main__":
     start = time.time()
-    main(1)
+    main(ciputil.get_level(sys.argv))
     elapse = time.time() - start
     print('\nelapse time: {}  sec'.format(elapse))
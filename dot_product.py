@@ -10,68 +10,129 @@ configure [DOT] section in config file.
     FLOW_THRESHOLD : If a pixel has flow with norm under FLOW_THRESHOLD, the flow is rounded to (0,0).
     DOT_THRESHOLD  : If a pixel has dot product value under DOT_THRESHOLD, it is drawn with a red circle in video. only used when DEFAULT.OUTPUT_VIDEO = yes.
     WINDOW_SIZE    : The size of neibor pixel window. Set ODD NUMBER and GREATOR THAN 3.
-    RECALCULATE    : Whether recalculate the dot product array or not.
-    DUMP_FILEPATH  : filepath to dump dotProduct_arr
+    BATCH_SIZE     : number of time points processed at once.
+    TILE_SIZE      : If > 0, the canvas is split into tiles of TILE_SIZE x TILE_SIZE pixels, and only the tiles with a flow over
+                     FLOW_THRESHOLD in or near them are evaluated (the others are 0). same values as TILE_SIZE = 0 (every pixel).
+    RECALCULATE    : Whether recalculate the dot product array or not. If no, the dumped array of the page is loaded.
+    DUMP_FILEPATH  : dotProduct_arr of a page is dumped to its directory as {level}_dot_{page}.npy
     VIDEO_FILEPATH : filepath to output video. only used when DEFAULT.OUTPUT_VIDEO = yes
 """
 
 import numpy as np
 import sys
 import time
-from matplotlib import pyplot as plt
-import cv2
-from configparser import ConfigParser
 
 import ciputil
+import flowstore
+import instrument
+import render
 
 TIME_MAX = None
 PAGE = None
 OUTPUT_VIDEO = None
 
-def calc_dot_product(cmlFlow_arr, windowSize, flowThreshold):
+def dot_product(flow_arr, windowSize, flowThreshold, padded=False):
+    """
+    return dotProduct_arr[batch][height][width] of minimum dot product for each pixel
+    for a batch of flows flow_arr[batch][height][width][2].
+    When padded, flow_arr already holds windowSize / 2 pixels of neighbors on each side of the height x width pixels.
+
+    dot product with each neighbor shift d (0 < |d| <= windowSize / 2) is the same array for d and -d,
+    only shifted, so each pair is computed once on views of one padded flow and reduced into a running minimum.
+    """
+    assert windowSize%2 == 1
+    assert windowSize >= 3
+
+    margin = int(windowSize/2)
+    if padded:
+        batch, height, width = flow_arr.shape[0], flow_arr.shape[1] - 2*margin, flow_arr.shape[2] - 2*margin
+        flowX = flow_arr[:, :, :, 0].astype(np.float64)
+        flowY = flow_arr[:, :, :, 1].astype(np.float64)
+    else:
+        batch, height, width = flow_arr.shape[:3]
+        flowX = np.zeros((batch, margin + height + margin, margin + width + margin)) #two direction +, -
+        flowY = np.zeros((batch, margin + height + margin, margin + width + margin))
+        flowX[:, margin:-margin, margin:-margin] = flow_arr[:, :, :, 0]
+        flowY[:, margin:-margin, margin:-margin] = flow_arr[:, :, :, 1]
+    smallFlow = flowX*flowX + flowY*flowY < flowThreshold
+    flowX[smallFlow] = 0
+    flowY[smallFlow] = 0
+
+    dotProduct_arr = np.full((batch, height, width), np.inf)
+    for xShift in range(margin + 1):
+        for yShift in range(-margin, margin + 1):
+            if xShift == 0 and yShift <= 0:
+                continue #(0, 0) is not a neighbor, (0, -yShift) is the reverse of (0, yShift)
+            #product[a] = flow[a]*flow[a + shift] for every a in (pixel) or (pixel - shift)
+            top, bottom = margin - xShift, margin + height
+            left, right = margin - max(yShift, 0), margin + width + max(-yShift, 0)
+            product = flowX[:, top:bottom, left:right] * flowX[:, top + xShift:bottom + xShift, left + yShift:right + yShift]
+            product += flowY[:, top:bottom, left:right] * flowY[:, top + xShift:bottom + xShift, left + yShift:right + yShift]
+
+            forwardLeft = max(yShift, 0)
+            np.minimum(dotProduct_arr, product[:, xShift:xShift + height, forwardLeft:forwardLeft + width], out=dotProduct_arr)
+            reverseLeft = max(-yShift, 0)
+            np.minimum(dotProduct_arr, product[:, :height, reverseLeft:reverseLeft + width], out=dotProduct_arr)
+    return dotProduct_arr
+
+def dot_product_tiles(flow_arr, windowSize, flowThreshold, tileSize, chunkSize=256):
+    """
+    same values as dot_product(flow_arr, windowSize, flowThreshold), evaluated only on the (frame, tile) of tileSize x tileSize pixels
+    which have a flow of norm over flowThreshold within windowSize / 2 pixels of the tile.
+    on the other tiles every flow of the window is rounded to (0, 0), so the dot product is 0.
+    the tiles with their margin are stacked and passed to dot_product, chunkSize tiles at once.
+    """
+    batch, height, width = flow_arr.shape[:3]
+    margin = int(windowSize/2)
+    numTileY, numTileX = -(-height // tileSize), -(-width // tileSize)
+
+    paddedFlow_arr = np.zeros((batch, numTileY * tileSize + 2 * margin, numTileX * tileSize + 2 * margin, 2))
+    paddedFlow_arr[:, margin : margin + height, margin : margin + width] = flow_arr
+    norm_arr = paddedFlow_arr[:, :, :, 0]*paddedFlow_arr[:, :, :, 0] + paddedFlow_arr[:, :, :, 1]*paddedFlow_arr[:, :, :, 1]
+    #number of moving pixels in the window (tile and its margin) of every (frame, tile), by an integral image
+    integral_arr = np.zeros((batch, norm_arr.shape[1] + 1, norm_arr.shape[2] + 1), np.int64)
+    integral_arr[:, 1:, 1:] = ((norm_arr >= flowThreshold) & (norm_arr > 0)).cumsum(axis=1).cumsum(axis=2)
+    first_arr = np.arange(numTileY)[:, None] * tileSize, np.arange(numTileX)[None, :] * tileSize
+    last_arr = first_arr[0] + tileSize + 2 * margin, first_arr[1] + tileSize + 2 * margin
+    moving_arr = (integral_arr[:, last_arr[0], last_arr[1]] - integral_arr[:, first_arr[0], last_arr[1]]
+                  - integral_arr[:, last_arr[0], first_arr[1]] + integral_arr[:, first_arr[0], first_arr[1]])
+    tile_lst = list(zip(*np.nonzero(moving_arr)))
+
+    dotProduct_arr = np.zeros((batch, numTileY * tileSize, numTileX * tileSize))
+    for first in range(0, len(tile_lst), chunkSize):
+        chunk_lst = tile_lst[first : first + chunkSize]
+        stack_arr = np.array([paddedFlow_arr[b, y*tileSize : (y + 1)*tileSize + 2*margin, x*tileSize : (x + 1)*tileSize + 2*margin]
+                              for b, y, x in chunk_lst])
+        stackDot_arr = dot_product(stack_arr, windowSize, flowThreshold, padded=True)
+        for n, (b, y, x) in enumerate(chunk_lst):
+            dotProduct_arr[b, y*tileSize : (y + 1)*tileSize, x*tileSize : (x + 1)*tileSize] = stackDot_arr[n]
+    instrument.count("dot_tiles", len(tile_lst))
+    instrument.count("dot_tiles_skipped", moving_arr.size - len(tile_lst))
+    return dotProduct_arr[:, :height, :width]
+
+def calc_dot_product(cmlFlow_arr, windowSize, flowThreshold, region=None, batchSize=8, tileSize=0):
     """
     return dotProduct_arr[time][960][960], 1 origin time
+    only region (top, left, height, width) of the canvas is evaluated, and dotProduct_arr is zero outside it.
+    this is exact as long as cmlFlow_arr is zero outside region (see ciputil.get_stabilized_region).
+    batchSize frames are processed at once.
+    When tileSize > 0, only the tiles with moving pixels are evaluated (see dot_product_tiles).
     """
 
     assert windowSize%2 == 1
     assert windowSize >= 3
 
-    def dot_product(flow, windowSize, flowThreshold):
-        """
-        return matrix[960][960] of minimum dot product for each pixel
-        """
-
-        assert flow.shape[0] == flow.shape[1]
-        width = flow.shape[0]
-        margin = int(windowSize/2)
-        widthMargin = margin + width + margin #two direction +, -
-
-        flow[np.sum(flow*flow, axis=2) < flowThreshold]=[0,0]
-        flowMargin = np.zeros((widthMargin, widthMargin, 2))
-        flowMargin[margin:-margin, margin:-margin] = flow
-
-        neighborNum = ((margin + 1)*(margin*2 + 1) - 1)*2 #((num of xShift) * (num of yShift) - (0,0)) * (reverse direction)
-        dotProductNeighbor = np.zeros ((neighborNum, widthMargin, widthMargin))
-        shiftIterator = 0
-        for xShift in range(margin + 1):
-            for yShift in range(-margin, margin + 1):
-                if (xShift != 0 or yShift != 0):
-                    shifted = np.zeros((widthMargin, widthMargin, 2))
-                    shifted[margin + xShift : margin + width + xShift, margin + yShift : margin + width + yShift] = flow
-                    dotProductNeighbor[shiftIterator] = np.sum(flowMargin * shifted, axis=2)
-                    dotProductNeighbor[shiftIterator + 1][margin:-margin, margin:-margin] \
-                        = dotProductNeighbor[shiftIterator][margin + xShift : margin + width + xShift, margin + yShift : margin + width + yShift]
-                    shiftIterator += 2
-        assert shiftIterator == neighborNum
-
-        dotProduct = np.min(dotProductNeighbor, axis=0)
-        return dotProduct[margin:-margin,margin:-margin]
-
-    dotProduct_arr = np.zeros((TIME_MAX + 1, 960, 960))
-    for time in range(2, TIME_MAX + 1):
-        print(time)
-        cmlFlow = cmlFlow_arr[time]
-        dotProduct_arr[time] = dot_product(cmlFlow, windowSize, flowThreshold)
+    top, left, height, width = region or ciputil.CANVAS_REGION
+    dotProduct_arr = np.zeros((TIME_MAX + 1, ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE))
+    for timeFirst in range(2, TIME_MAX + 1, batchSize):
+        time_lst = list(range(timeFirst, min(timeFirst + batchSize, TIME_MAX + 1)))
+        instrument.count("dot_batches")
+        cmlFlowBatch_arr = np.array([cmlFlow_arr[time][top : top + height, left : left + width] for time in time_lst], np.float64)
+        if tileSize > 0:
+            dotBatch_arr = dot_product_tiles(cmlFlowBatch_arr, windowSize, flowThreshold, tileSize)
+        else:
+            dotBatch_arr = dot_product(cmlFlowBatch_arr, windowSize, flowThreshold)
+        dotProduct_arr[time_lst[0] : time_lst[-1] + 1, top : top + height, left : left + width] = dotBatch_arr
     return dotProduct_arr
 
 def output_dot_video(dotProduct_arr, dotProductThreshold, fixDirection_arr, videoFilepath):
@@ -79,61 +140,64 @@ def output_dot_video(dotProduct_arr, dotProductThreshold, fixDirection_arr, vide
     output a video with circle at small (big minus) dot product pixel
     """
 
-    fourcc = int(cv2.VideoWriter_fourcc(*'avc1'))
-    video = cv2.VideoWriter(videoFilepath, fourcc, 5.0, (960, 960))
+    video = render.VideoWriter(videoFilepath, 5.0, (ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE), ciputil.VIDEO_QUEUE)
 
-    for time in range(1, TIME_MAX + 1):
+    for time, img in ciputil.frames(ciputil.LEVEL, PAGE, stride=ciputil.VIDEO_STRIDE):
         print("time:{}".format(time))
-        img = ciputil.get_image(time=time, page=PAGE)
         stabImg = ciputil.get_stabilized_image(img, fixDirection_arr[PAGE][time])
 
-        divisionPoint_arr = np.array(np.array(np.where(dotProduct_arr[time] < dotProductThreshold)))
-
-        dotImg = stabImg
-        assert divisionPoint_arr.shape[0] == 2
-        numPoints = divisionPoint_arr.shape[1]
-        for i in range(numPoints):
-            x = divisionPoint_arr[1][i]
-            y = divisionPoint_arr[0][i]
-            dotImg = cv2.circle(dotImg, (x, y), 3, (255,0,0), -1)
+        y_arr, x_arr = np.nonzero(dotProduct_arr[time] < dotProductThreshold)
+        dotImg = render.draw_points(stabImg, y_arr, x_arr, 3, (255,0,0))
         video.write(dotImg)
     video.release()
 
-def main(level):
+@instrument.measured("dot")
+def run_page(level, page, configFilepath="./config/config.ini"):
+    """
+    calculate and dump dot product of a page.
+    return filepath of the dumped dotProduct_arr.
+    """
     global TIME_MAX
     global PAGE
 
-    configFilepath = "./config/config.ini"
     TIME_MAX, PAGE_MAX, OUTPUT_VIDEO = ciputil.read_config(configFilepath, level)
-    PAGE, windowSize, cmlFlowFilepath, videoFilepath = ciputil.read_config_cumulative(configFilepath)
-    #cmlFlow_arr = np.load(cmlFlowFilepath)
-    recalculate, windowSize, flowThreshold, dotThreshold, dumpFilepath, videoFilepath = ciputil.read_config_dot(configFilepath)
-
-    for page in range(1, PAGE_MAX+1):
-        PAGE = page
-
-        if recalculate:
-            print("START: calculating dot product")
-            cmlFlowFilepath = "./out/{0}_cml_{1}.npy".format(level, page)
-            cmlFlow_arr = np.load(cmlFlowFilepath)
-            dotProduct_arr = calc_dot_product(cmlFlow_arr, windowSize, flowThreshold)
-            dumpFilepath = "./out/{0}_dot_{1}.npy".format(level, page)
-            np.save(dumpFilepath, dotProduct_arr)
-            print("DONE: dump to {}".format(dumpFilepath))
-        else:
-            dotProduct_arr = np.load(dumpFilepath)
-            print("DONE: load dot product array from {}".format(dumpFilepath))
+    recalculate, windowSize, flowThreshold, dotThreshold, dumpFilepath, videoFilepath, batchSize, tileSize = ciputil.read_config_dot(configFilepath)
+    PAGE = page
+
+    _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
+    fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+    fixDirection_arr = np.load(fixDirectionFilepath)
+
+    if recalculate:
+        print("START: calculating dot product")
+        cmlFlowFilepath = ciputil.dump_filepath("cml", level, page)
+        cmlFlow_arr = flowstore.load(cmlFlowFilepath)
+        region = ciputil.get_stabilized_region(fixDirection_arr, PAGE, TIME_MAX)
+        dotProduct_arr = calc_dot_product(cmlFlow_arr, windowSize, flowThreshold, region, batchSize, tileSize)
+        instrument.add_work(TIME_MAX, TIME_MAX * region[2] * region[3])
+        storeFormat, storeDtype, storeCrop = ciputil.read_config_store(configFilepath)
+        dumpFilepath = ciputil.dump_filepath("dot", level, page)
+        flowstore.save(dumpFilepath, dotProduct_arr, storeFormat, storeDtype, storeCrop)
+        print("DONE: dump to {}".format(dumpFilepath))
+    else:
+        dumpFilepath = ciputil.dump_filepath("dot", level, page)
+        dotProduct_arr = flowstore.load(dumpFilepath)
+        print("DONE: load dot product array from {}".format(dumpFilepath))
+
+    if OUTPUT_VIDEO:
+        videoFilepath = ciputil.OUTDIR + "/{0}_dot_{1}.mp4".format(level, page)
+        output_dot_video(dotProduct_arr, dotThreshold, fixDirection_arr,videoFilepath)
+        print("DONE: output video to {}".format(videoFilepath))
+    return dumpFilepath
 
-        if OUTPUT_VIDEO:
-            _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(configFilepath)
-            fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
-            fixDirection_arr = np.load(fixDirectionFilepath)
-            videoFilepath = "./out/{0}_dot_{1}.mp4".format(level, page)
-            output_dot_video(dotProduct_arr, dotThreshold, fixDirection_arr,videoFilepath)
-            print("DONE: output video to {}".format(videoFilepath))
+def main(level):
+    configFilepath = "./config/config.ini"
+    _, pageMax, _ = ciputil.read_config(configFilepath, level)
+    for page in range(1, pageMax+1):
+        run_page(level, page, configFilepath)
 
 if __name__ == "__main__":
     start = time.time()
-    main()
+    main(ciputil.get_level(sys.argv))
     elapse = time.time() - start
     print("\nelapse time: {} sec".format(elapse))
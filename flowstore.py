@@ -0,0 +1,152 @@
+# coding: utf-8
+
+"""
+compact on-disk format of per-page arrays (cmlFlow_arr, dotProduct_arr).
+
+a store is a directory (e.g. ./out/1_cml_33.store) with
+    meta.json : frame shape, dtype, crop
+    index.npy : index_arr[time] = offset, top, left, height, width of the frame in data.bin
+    data.bin  : frames appended one by one in dtype. a frame written again is overwritten in place when its crop has
+                the same size, and appended otherwise (the old crop is left unused in data.bin).
+When crop is enabled, only the bounding box of the non-zero region of a frame is written,
+so the area masked out by stabilization costs nothing.
+data.bin is memory-mapped on reading, and only the requested time is touched.
+
+configure [STORE] section in "config/config.ini".
+    FORMAT : "npy" (a .npy file like before, default) or "chunked" (store directory).
+    DTYPE  : dtype of the stored values, "float64" (default), "float32" or "float16".
+             "chunked" with "float32" makes the dumps much smaller, but the values differ from the npy float64 dumps
+             in the last digits, so the answer files may differ slightly.
+    CROP   : If yes, only the bounding box of the non-zero region of each frame is stored (chunked only).
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+
+def store_dirpath(filepath):
+    """
+    ./out/1_cml_33.npy -> ./out/1_cml_33.store
+    """
+    return os.path.splitext(filepath)[0] + ".store"
+
+
+class FlowStore:
+    """
+    time-indexed array of frames. store[time] returns a dense frame in the dtype of the store.
+    """
+    def __init__(self, dirpath):
+        with open(dirpath + "/meta.json", "r") as f:
+            meta = json.load(f)
+        self.dirpath = dirpath
+        self.frameShape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.crop = meta["crop"]
+        self.index_arr = np.load(dirpath + "/index.npy")
+        self.shape = (len(self.index_arr),) + self.frameShape
+        self._data = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _data_arr(self, end):
+        if end == 0:
+            return np.zeros(0, self.dtype)
+        if self._data is None or len(self._data) < end:
+            #re-map after frames were appended
+            self._data = np.memmap(self.dirpath + "/data.bin", dtype=self.dtype, mode="r")
+        return self._data
+
+    def get_crop(self, time):
+        """
+        return stored crop of the frame at time and its (top, left) in the frame
+        """
+        offset, top, left, height, width = [int(i) for i in self.index_arr[time]]
+        size = height * width * int(np.prod(self.frameShape[2:]))
+        crop = self._data_arr(offset + size)[offset : offset + size]
+        return crop.reshape((height, width) + self.frameShape[2:]), (top, left)
+
+    def __getitem__(self, time):
+        crop, (top, left) = self.get_crop(time)
+        frame = np.zeros(self.frameShape, self.dtype)
+        frame[top : top + crop.shape[0], left : left + crop.shape[1]] = crop
+        return frame
+
+    def __setitem__(self, time, frame):
+        frame = np.asarray(frame)
+        assert frame.shape == self.frameShape
+        if self.crop:
+            nonzero = frame != 0
+            if nonzero.ndim == 3:
+                nonzero = np.any(nonzero, axis=2)
+            row_arr = np.flatnonzero(np.any(nonzero, axis=1))
+            col_arr = np.flatnonzero(np.any(nonzero, axis=0))
+            if len(row_arr) == 0:
+                top, left, height, width = 0, 0, 0, 0
+            else:
+                top, left = row_arr[0], col_arr[0]
+                height, width = row_arr[-1] + 1 - top, col_arr[-1] + 1 - left
+        else:
+            top, left = 0, 0
+            height, width = self.frameShape[:2]
+
+        crop = np.ascontiguousarray(frame[top : top + height, left : left + width], self.dtype)
+        offset, _, _, oldHeight, oldWidth = [int(i) for i in self.index_arr[time]]
+        if oldHeight * oldWidth == height * width:
+            #rewrite of a frame: overwrite its crop in place
+            with open(self.dirpath + "/data.bin", "r+b") as f:
+                f.seek(offset * self.dtype.itemsize)
+                f.write(crop.tobytes())
+        else:
+            with open(self.dirpath + "/data.bin", "ab") as f:
+                offset = f.tell() // self.dtype.itemsize
+                f.write(crop.tobytes())
+        self.index_arr[time] = [offset, top, left, height, width]
+
+    def flush(self):
+        np.save(self.dirpath + "/index.npy", self.index_arr)
+
+
+def create(filepath, shape, fmt="npy", dtype="float64", crop=True):
+    """
+    return a writable array of shape (time, ...) dumped to filepath. call flush() after writing.
+        fmt = "chunked" : FlowStore in store_dirpath(filepath)
+        fmt = "npy"     : memory-mapped .npy file
+    """
+    dirpath = store_dirpath(filepath)
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+    if fmt == "npy":
+        return np.lib.format.open_memmap(filepath, mode="w+", dtype=dtype, shape=shape)
+    elif fmt == "chunked":
+        os.makedirs(dirpath)
+        with open(dirpath + "/meta.json", "w") as f:
+            json.dump({"shape": list(shape[1:]), "dtype": np.dtype(dtype).name, "crop": crop}, f)
+        open(dirpath + "/data.bin", "wb").close()
+        np.save(dirpath + "/index.npy", np.zeros((shape[0], 5), np.int64))
+        return FlowStore(dirpath)
+    else:
+        raise ValueError("Unknown store format: {}".format(fmt))
+
+def save(filepath, arr, fmt="npy", dtype="float64", crop=True):
+    """
+    dump whole arr[time][...] to filepath
+    """
+    store = create(filepath, arr.shape, fmt, dtype, crop)
+    for time in range(len(arr)):
+        store[time] = arr[time]
+    store.flush()
+
+def load(filepath):
+    """
+    open an array dumped by create/save (or np.save) without reading it into memory.
+    """
+    dirpath = store_dirpath(filepath)
+    if os.path.isdir(dirpath):
+        return FlowStore(dirpath)
+    return np.load(filepath, mmap_mode="r")
@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+instrumentation of the stages: wall time, CPU time, peak RSS and work (frames, pixels, ...) per stage and page.
+
+configure [PROFILE] section in "config/config.ini".
+    ENABLE           : If yes, each measured (stage, level, page) appends a record to REPORT_FILEPATH.
+    REPORT_FILEPATH  : report of JSON lines (one record per line, appended by all processes).
+    CPROFILE_STAGE   : stage to run under cProfile (empty: none). works even if ENABLE is no.
+    CPROFILE_DIRPATH : cProfile dumps go to CPROFILE_DIRPATH/{level}_{stage}_{page}.prof (see pstats).
+
+ciputil and the stages add to the counters of this process (count, add_work),
+and a record holds the increase of the counters during the stage:
+    frames, pixels     : frames and pixels processed by the stage
+    points             : candidate points clustered
+    images_decoded     : tif files decoded, decode_s: time spent decoding them
+    cache_hits         : images served from the image cache
+    flows, flow_s      : dense flows calculated, time spent calculating them
+    dot_tiles          : (frame, tile) evaluated by dot_product.dot_product_tiles, dot_tiles_skipped: those skipped
+
+usage: ./instrument.py REPORT_FILEPATH [CSV_FILEPATH]
+    print the totals of each (level, stage), and convert the report to csv.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import functools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from configparser import ConfigParser
+
+ENABLE = False
+REPORT_FILEPATH = None
+CPROFILE_STAGE = None
+CPROFILE_DIRPATH = None
+
+counter_dct = defaultdict(float)
+counterLock = threading.Lock()  # counters are also updated from the threads of ciputil.iter_dense_flows
+
+
+def configure(configFilepath):
+    global ENABLE
+    global REPORT_FILEPATH
+    global CPROFILE_STAGE
+    global CPROFILE_DIRPATH
+
+    config = ConfigParser()
+    config.read(configFilepath)
+    ENABLE = config.getboolean("PROFILE", "ENABLE")
+    REPORT_FILEPATH = config["PROFILE"]["REPORT_FILEPATH"]
+    CPROFILE_STAGE = config["PROFILE"]["CPROFILE_STAGE"] or None
+    CPROFILE_DIRPATH = config["PROFILE"]["CPROFILE_DIRPATH"]
+
+def count(name, value=1):
+    with counterLock:
+        counter_dct[name] += value
+
+def add_work(frames, pixels):
+    with counterLock:
+        counter_dct["frames"] += frames
+        counter_dct["pixels"] += pixels
+
+def reset_peak_rss():
+    """
+    reset the peak RSS of this process (linux only), so that the peak of each stage is measured
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def get_peak_rss():
+    """
+    peak RSS of this process in MB
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextmanager
+def measure(stage, level, page=None):
+    """
+    measure the block as (stage, level, page). configure() must have been called.
+    a block that raises is not recorded.
+    """
+    if not ENABLE and stage != CPROFILE_STAGE:
+        yield
+        return
+
+    start_dct = dict(counter_dct)
+    reset_peak_rss()
+    profile = cProfile.Profile() if stage == CPROFILE_STAGE else None
+    startTime = time.time()
+    startWall = time.perf_counter()
+    startCpu = time.process_time()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+    wall = time.perf_counter() - startWall
+    cpu = time.process_time() - startCpu
+
+    if profile is not None:
+        os.makedirs(CPROFILE_DIRPATH, exist_ok=True)
+        profile.dump_stats(CPROFILE_DIRPATH + "/{0}_{1}_{2}.prof".format(level, stage, "all" if page is None else page))
+    if ENABLE:
+        record = {"stage": stage, "level": level, "page": page, "pid": os.getpid(), "start": startTime,
+                  "wall_s": wall, "cpu_s": cpu, "peak_rss_mb": get_peak_rss()}
+        for name, value in counter_dct.items():
+            record[name] = value - start_dct.get(name, 0)
+        record["frames_per_s"] = record.get("frames", 0) / wall if wall > 0 else 0
+        record["pixels_per_s"] = record.get("pixels", 0) / wall if wall > 0 else 0
+        write_record(record)
+
+def write_record(record):
+    dirpath = os.path.dirname(REPORT_FILEPATH)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    #one write of one line in append mode, so that records of processes are not mixed
+    with open(REPORT_FILEPATH, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def measured(stage):
+    """
+    decorator of a task runPage(level, page, configFilepath), which measures it as (stage, level, page)
+    """
+    def decorator(runPage):
+        @functools.wraps(runPage)
+        def wrapper(level, page, configFilepath="./config/config.ini"):
+            configure(configFilepath)
+            with measure(stage, level, page):
+                return runPage(level, page, configFilepath)
+        return wrapper
+    return decorator
+
+def read_report(reportFilepath):
+    with open(reportFilepath, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_csv(record_lst, csvFilepath):
+    field_lst = []
+    for record in record_lst:
+        field_lst += [field for field in record if field not in field_lst]
+    with open(csvFilepath, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=field_lst, restval=0)
+        writer.writeheader()
+        writer.writerows(record_lst)
+
+def summarize(record_lst):
+    """
+    return list of totals of each (level, stage): number of records, wall/cpu time, max peak RSS and throughput
+    """
+    total_dct = {}
+    for record in record_lst:
+        key = (record["level"], record["stage"])
+        if key not in total_dct:
+            total_dct[key] = {"level": key[0], "stage": key[1], "records": 0, "wall_s": 0, "cpu_s": 0,
+                              "peak_rss_mb": 0, "frames": 0, "pixels": 0}
+        total = total_dct[key]
+        total["records"] += 1
+        total["wall_s"] += record["wall_s"]
+        total["cpu_s"] += record["cpu_s"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        total["frames"] += record.get("frames", 0)
+        total["pixels"] += record.get("pixels", 0)
+    for total in total_dct.values():
+        total["frames_per_s"] = total["frames"] / total["wall_s"] if total["wall_s"] > 0 else 0
+    return [total_dct[key] for key in sorted(total_dct, key=lambda key: (key[0], key[1]))]
+
+def main(reportFilepath, csvFilepath=None):
+    record_lst = read_report(reportFilepath)
+    print("{:>5} {:<14} {:>7} {:>10} {:>10} {:>12} {:>12}".format(
+        "level", "stage", "records", "wall_s", "cpu_s", "peak_rss_mb", "frames/s"))
+    for total in summarize(record_lst):
+        print("{level:>5} {stage:<14} {records:>7} {wall_s:>10.2f} {cpu_s:>10.2f} {peak_rss_mb:>12.1f} {frames_per_s:>12.2f}".format(**total))
+    if csvFilepath is not None:
+        write_csv(record_lst, csvFilepath)
+        print("DONE: write {}".format(csvFilepath))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: ./instrument.py REPORT_FILEPATH [CSV_FILEPATH]")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,334 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+run the whole pipeline (stabilize -> cumulative_flow -> dot_product -> detect) for levels.
+the work is split into tasks (level, stage, page), which are scheduled on one shared process pool
+as soon as the tasks they depend on are finished:
+    stabilize  (level, page) : movement of a page. when all pages are done, fixDirection of the level is reduced and dumped.
+    cumulative (level, page) : after stabilize of the level.
+    dot        (level, page) : after cumulative of the page.
+    detect     (level)       : after dot of all pages of the level.
+if [CANDIDATES] FUSED, a candidates task (level, page) (see candidates.py) replaces cumulative and dot of the page,
+and counts as the dot stage for --first and --last.
+so stabilize of level 2 overlaps with dot of level 1, and the pool stays busy.
+workers dump their arrays to ./out/{level}_cml_{page}.npy, ./out/{level}_dot_{page}.npy
+and return only the filepath, so no large array is passed between processes.
+videos of stabilize are not rendered by the pipeline (run ./stabilize.py for them).
+
+configure [PIPELINE] section in "config/config.ini".
+    WORKERS          : number of worker processes.
+    RETRY            : number of times a failed task is retried. a task failed by the crash of another task's worker
+                       is run again without counting an attempt (see Scheduler).
+    INCREMENTAL      : If yes, tasks whose inputs and config are unchanged since the last run are skipped (see artifact.py).
+                       an interrupted run resumes at the unfinished tasks.
+    MANIFEST_DIRPATH : directory of the manifests of finished tasks.
+
+usage: ./pipeline.py [level ...] [--first STAGE] [--last STAGE]
+    stages before --first must have been run before (their outputs are read).
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import ciputil
+import artifact
+import stabilize
+import cumulative_flow
+import dot_product
+import candidates
+import detect
+
+STAGES = ["stabilize", "cumulative", "dot", "detect"]
+
+
+def run_detect(level, page, configFilepath="./config/config.ini"):
+    """
+    detect.main in a worker process. page is None (detect is run once for a level).
+    return filepath of the answer file.
+    """
+    detect.main(level, configFilepath)
+    return ciputil.answer_filepath(level)
+
+RUN_TASK = {
+    "stabilize" : stabilize.calc_page_movement_worker,
+    "cumulative": cumulative_flow.run_page,
+    "dot"       : dot_product.run_page,
+    "candidates": candidates.run_page,
+    "detect"    : run_detect,
+}
+
+class Scheduler:
+    """
+    dependency tracking of the tasks of levels. a task is submitted to the pool when it becomes ready,
+    and finishing a task makes the tasks depending on it ready.
+    a task which failed RETRY + 1 times is given up, together with the tasks depending on it
+    (the other levels and pages go on).
+    at most `workers` tasks are submitted at a time, so all tasks on the pool are running. a crashed worker breaks
+    the pool and fails all of them without telling which one crashed: they are run again one by one in a pool of
+    one worker (the isolation pool) without counting an attempt, and only a task crashing there counts the attempt.
+    """
+    def __init__(self, level_lst, stageFirst, stageLast, workers, retry, incremental, manifestDirpath, configFilepath):
+        self.level_lst = level_lst
+        self.first = STAGES.index(stageFirst)
+        self.last = STAGES.index(stageLast)
+        self.workers = workers
+        self.retry = retry
+        self.incremental = incremental
+        self.manifestDirpath = manifestDirpath
+        self.configFilepath = configFilepath
+        self.config = ciputil.set_config(configFilepath)
+        fused, _ = ciputil.read_config_candidates(configFilepath)
+        self.dotStage = "candidates" if fused else "dot"  # stage whose outputs detect reads
+
+        self.executor = None
+        self.future_dct = {}  # future -> task (level, stage, page)
+        self.ready_lst = []  # tasks waiting for a free worker
+        self.broken = False  # a worker of self.executor crashed
+        self.isolationExecutor = None
+        self.isolated_dct = {}  # future -> task running alone in the isolation pool (at most one)
+        self.suspect_lst = []  # tasks which were running when the pool broke
+        self.attempt_dct = {}  # task -> number of failed attempts
+        self.failed_lst = []
+
+        self.pageMax_dct = {}
+        self.fingerprint_dct = {}  # level -> page -> fingerprint of images
+        self.key_dct = {}  # (level, stage) -> page -> key
+        self.movement_dct = {}  # level -> page -> result of calc_page_movement_worker
+        self.dotDone_dct = {}  # level -> set of pages whose dot (or candidates) is done
+        self.fixDirection_dct = {}
+
+    def stage_index(self, stage):
+        return STAGES.index("dot" if stage == "candidates" else stage)
+
+    def in_range(self, stage):
+        return self.first <= self.stage_index(stage) <= self.last
+
+    def is_up_to_date(self, level, stage, page, key):
+        return self.incremental and artifact.is_up_to_date(self.manifestDirpath, stage, level, page, key)
+
+    def submit(self, task):
+        self.ready_lst.append(task)
+
+    def fill_pool(self):
+        """
+        submit ready tasks while a worker is free
+        """
+        while len(self.ready_lst) > 0 and len(self.future_dct) < self.workers and not self.broken:
+            level, stage, page = self.ready_lst[0]
+            try:
+                future = self.executor.submit(RUN_TASK[stage], level, page, self.configFilepath)
+            except BrokenProcessPool:
+                #a worker crashed since the last wait
+                self.broken = True
+                return
+            self.future_dct[future] = self.ready_lst.pop(0)
+
+    def submit_isolated(self):
+        """
+        run the next suspect alone in the isolation pool, so that a crash of its worker is known to be caused by it
+        """
+        if len(self.isolated_dct) > 0 or len(self.suspect_lst) == 0:
+            return
+        level, stage, page = task = self.suspect_lst.pop(0)
+        for _ in range(2):
+            if self.isolationExecutor is None:
+                self.isolationExecutor = ProcessPoolExecutor(max_workers=1)
+            try:
+                self.isolated_dct[self.isolationExecutor.submit(RUN_TASK[stage], level, page, self.configFilepath)] = task
+                return
+            except BrokenProcessPool:
+                #its idle worker was killed
+                self.isolationExecutor.shutdown(wait=True)
+                self.isolationExecutor = None
+        raise RuntimeError("the isolation pool cannot be started")
+
+    def renew_pool(self):
+        """
+        replace the broken pool by a new one. return the futures of the broken pool which are not collected yet
+        """
+        self.executor.shutdown(wait=True)  # the futures of the broken pool are settled
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.broken = False
+        return list(self.future_dct)
+
+    def collect(self, future):
+        """
+        return (task, output, exception) of a finished future, or None when the task is a suspect of a crash
+        """
+        if future in self.isolated_dct:
+            task = self.isolated_dct.pop(future)
+            try:
+                return task, future.result(), None
+            except BrokenProcessPool as e:
+                #the task ran alone, so it crashed the worker
+                self.isolationExecutor.shutdown(wait=True)
+                self.isolationExecutor = None
+                return task, None, e
+            except Exception as e:
+                return task, None, e
+        task = self.future_dct.pop(future)
+        try:
+            return task, future.result(), None
+        except BrokenProcessPool:
+            self.broken = True
+            self.suspect_lst.append(task)
+            return None
+        except Exception as e:
+            return task, None, e
+
+    def run_or_skip(self, level, stage, page, key):
+        """
+        submit (level, stage, page), or skip it when it is out of range or up to date.
+        """
+        if not self.in_range(stage):
+            if self.stage_index(stage) < self.first:
+                self.on_done((level, stage, page), None)
+        elif stage != "stabilize" and self.is_up_to_date(level, stage, page, key):
+            print("SKIP: {}, level = {}, page = {}".format(stage, level, page))
+            self.on_done((level, stage, page), None)
+        else:
+            self.submit((level, stage, page))
+
+    def start_level(self, level):
+        timeMax, pageMax, _ = ciputil.read_config(self.configFilepath, level)
+        self.pageMax_dct[level] = pageMax
+        self.dotDone_dct[level] = set()
+        self.movement_dct[level] = {}
+        page_lst = range(1, pageMax + 1)
+        self.fingerprint_dct[level] = {page: artifact.image_fingerprint(page, timeMax) for page in page_lst}
+
+        key = artifact.stage_key("stabilize", self.config, [self.fingerprint_dct[level][page] for page in page_lst])
+        self.key_dct[(level, "stabilize")] = {None: key}
+        if not self.in_range("stabilize"):
+            self.on_stabilized(level)
+        elif self.is_up_to_date(level, "stabilize", None, key):
+            print("SKIP: stabilize, level = {}".format(level))
+            self.on_stabilized(level)
+        else:
+            for page in page_lst:
+                self.submit((level, "stabilize", page))
+
+    def on_stabilized(self, level):
+        _, fixDirectionFilepath, _ = ciputil.read_config_stabilize(self.configFilepath)
+        fixDirectionFilepath = fixDirectionFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+        fixDirection_arr = np.load(fixDirectionFilepath)
+        self.fixDirection_dct[level] = fixDirection_arr
+
+        #a page is recalculated only when its own fix direction, images or config changed
+        page_lst = range(1, self.pageMax_dct[level] + 1)
+        if self.dotStage == "candidates":
+            candKey_dct = {page: artifact.stage_key("candidates", self.config, fixDirection_arr[page],
+                                                    self.fingerprint_dct[level][page]) for page in page_lst}
+            self.key_dct[(level, "candidates")] = candKey_dct
+            for page in page_lst:
+                self.run_or_skip(level, "candidates", page, candKey_dct[page])
+            return
+        cmlKey_dct = {page: artifact.stage_key("cumulative", self.config, fixDirection_arr[page],
+                                               self.fingerprint_dct[level][page]) for page in page_lst}
+        self.key_dct[(level, "cumulative")] = cmlKey_dct
+        self.key_dct[(level, "dot")] = {page: artifact.stage_key("dot", self.config, cmlKey_dct[page]) for page in page_lst}
+        for page in page_lst:
+            self.run_or_skip(level, "cumulative", page, cmlKey_dct[page])
+
+    def on_done(self, task, output):
+        """
+        record a finished (or skipped: output is None) task and start the tasks depending on it.
+        """
+        level, stage, page = task
+        if output is not None and stage != "stabilize":
+            artifact.record(self.manifestDirpath, stage, level, page, self.key_dct[(level, stage)][page], output)
+
+        if stage == "stabilize":
+            self.movement_dct[level][page] = output
+            if len(self.movement_dct[level]) == self.pageMax_dct[level]:
+                print("START: reduce fix direction, level = {}".format(level))
+                output = stabilize.dump_fix_direction(level, self.movement_dct.pop(level), self.configFilepath)
+                artifact.record(self.manifestDirpath, stage, level, None, self.key_dct[(level, stage)][None], output)
+                print("DONE: stabilize, level = {}".format(level))
+                self.on_stabilized(level)
+        elif stage == "cumulative":
+            self.run_or_skip(level, "dot", page, self.key_dct[(level, "dot")][page])
+        elif stage in ("dot", "candidates"):
+            self.dotDone_dct[level].add(page)
+            if len(self.dotDone_dct[level]) == self.pageMax_dct[level]:
+                print("DONE: {}, level = {}".format(stage, level))
+                page_lst = range(1, self.pageMax_dct[level] + 1)
+                detectKey = artifact.stage_key("detect", self.config, self.fixDirection_dct[level],
+                                               [self.key_dct[(level, stage)][page] for page in page_lst])
+                self.key_dct[(level, "detect")] = {None: detectKey}
+                self.run_or_skip(level, "detect", None, detectKey)
+        elif stage == "detect" and output is not None:
+            print("DONE: detect, level = {}, answer = {}".format(level, output))
+
+    def on_failed(self, task, e):
+        self.attempt_dct[task] = self.attempt_dct.get(task, 0) + 1
+        print("FAILED({}/{}): {}, {}".format(self.attempt_dct[task], self.retry + 1, task, repr(e)))
+        if self.attempt_dct[task] <= self.retry:
+            self.submit(task)
+        else:
+            self.failed_lst.append(task)
+
+    def run(self):
+        """
+        return list of tasks that failed every attempt
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for level in self.level_lst:
+                self.start_level(level)
+            self.fill_pool()
+            while len(self.future_dct) + len(self.isolated_dct) + len(self.ready_lst) > 0:
+                done_set = set()
+                if not self.broken:
+                    done_set, _ = wait(list(self.future_dct) + list(self.isolated_dct), return_when=FIRST_COMPLETED)
+                result_lst = [self.collect(future) for future in done_set]  # (task, output, exception)
+                #the new pool is made before the failed tasks are retried and the next tasks are submitted
+                if self.broken:
+                    result_lst += [self.collect(future) for future in self.renew_pool()]
+                    self.broken = False
+                for result in result_lst:
+                    if result is None:
+                        continue
+                    task, output, e = result
+                    if e is None:
+                        self.on_done(task, output)
+                    else:
+                        self.on_failed(task, e)
+                self.fill_pool()
+                self.submit_isolated()
+        finally:
+            self.executor.shutdown()
+            if self.isolationExecutor is not None:
+                self.isolationExecutor.shutdown()
+        return self.failed_lst
+
+def run_batch(level_lst, stageFirst="stabilize", stageLast="detect", configFilepath="./config/config.ini"):
+    workers, retry = ciputil.read_config_pipeline(configFilepath)
+    incremental, manifestDirpath = ciputil.read_config_incremental(configFilepath)
+    print("START: levels = {}, stages = {} - {}, workers = {}".format(level_lst, stageFirst, stageLast, workers))
+    scheduler = Scheduler(level_lst, stageFirst, stageLast, workers, retry, incremental, manifestDirpath, configFilepath)
+    failed_lst = scheduler.run()
+    if len(failed_lst) > 0:
+        print("FAILED: tasks = {}".format(failed_lst))
+        sys.exit(1)
+    print("DONE: levels = {}".format(level_lst))
+
+def main(level):
+    run_batch([level])
+
+if __name__ == "__main__":
+    start = time.time()
+    parser = argparse.ArgumentParser(prog="pipeline.py", description="run the pipeline for levels")
+    parser.add_argument("level", nargs="*", type=int, help="levels (default: LEVEL of config)")
+    parser.add_argument("--first", choices=STAGES, default=STAGES[0], help="first stage to run")
+    parser.add_argument("--last", choices=STAGES, default=STAGES[-1], help="last stage to run")
+    args = parser.parse_args()
+    level_lst = args.level or [ciputil.get_level([])]
+    run_batch(level_lst, args.first, args.last)
+    elapse = time.time() - start
+    print("\nelapse time: {} sec".format(elapse))
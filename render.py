@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""
+rendering of the videos of tr_image_movie.py and of the stages (output_*_video).
+    reader  : images are read ahead in background threads (ciputil.frames, ciputil.prefetch).
+    overlay : all circles, boxes or lines of a frame are rasterized together (draw_points, draw_boxes, draw_lines),
+              with the same pixels as cv2.circle, cv2.rectangle and cv2.line drawn one by one.
+    encoder : VideoWriter encodes the frames in a background thread fed through a bounded queue,
+              so encoding overlaps reading and drawing of the next frames.
+"""
+
+import queue
+import threading
+import numpy as np
+import cv2
+
+QUEUE_SIZE = 16  # frames waiting for the encoder
+
+
+def disk(radius):
+    """
+    kernel[2 * radius + 1][2 * radius + 1] of the pixels of a filled cv2.circle of radius
+    """
+    kernel = np.zeros((2 * radius + 1, 2 * radius + 1), np.uint8)
+    cv2.circle(kernel, (radius, radius), radius, 1, -1)
+    return kernel
+
+def draw_points(img, y_arr, x_arr, radius, color):
+    """
+    draw filled circles of radius centered at all points (y_arr, x_arr): the mask of the points is dilated by a disk
+    """
+    if len(y_arr) == 0:
+        return img
+    mask = np.zeros(img.shape[:2], np.uint8)
+    mask[y_arr, x_arr] = 1
+    img[cv2.dilate(mask, disk(radius)) > 0] = color
+    return img
+
+def draw_boxes(img, box_arr, color, thickness):
+    """
+    draw the outlines of boxes box_arr[boxes][4] = (x1, y1, x2, y2) in one cv2.polylines
+    """
+    if len(box_arr) == 0:
+        return img
+    x1, y1, x2, y2 = np.asarray(box_arr, np.int32).T
+    corner_arr = np.stack([np.stack(corner, axis=1) for corner in ((x1, y1), (x2, y1), (x2, y2), (x1, y2))], axis=1)
+    cv2.polylines(img, list(corner_arr), True, color, thickness)
+    return img
+
+def draw_lines(img, line_arr, color, thickness):
+    """
+    draw line segments line_arr[lines][2][2] = ((x1, y1), (x2, y2)) in one cv2.polylines
+    """
+    if len(line_arr) == 0:
+        return img
+    cv2.polylines(img, np.asarray(line_arr, np.int32), False, color, thickness)
+    return img
+
+class VideoWriter:
+    """
+    cv2.VideoWriter (avc1) whose frames are encoded in a background thread.
+    write() blocks only when queueSize frames are waiting, and a frame must not be modified after write().
+    an error of the encoder is raised by the next write() or release().
+    """
+    def __init__(self, videoFilepath, fps, size, queueSize=QUEUE_SIZE):
+        fourcc = int(cv2.VideoWriter_fourcc(*'avc1'))
+        self.video = cv2.VideoWriter(videoFilepath, fourcc, fps, size)
+        self.queue = queue.Queue(maxsize=max(queueSize, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+    def encode(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is None:
+                try:
+                    self.video.write(frame)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def release(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.video.release()
+        if self.error is not None:
+            raise self.error
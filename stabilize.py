@@ -16,9 +16,10 @@ import time
 import numpy as np
 import statistics as st
 import cv2
-import matplotlib.pyplot as plt
 from configparser import ConfigParser
 import ciputil
+import instrument
+import render
 
 TIME_MAX = None
 PAGE_MAX = None
@@ -28,106 +29,195 @@ class FeatureError(Exception):
     def __init__(self, value):
         self.value = value
 
-def calc_fix_direction(angleThresh):
+#corner detection parameter of Shi-Tomasi
+FEATURE_PARAMS = dict(maxCorners = 200,
+                        qualityLevel = 0.001,
+                        minDistance = 10,
+                        blockSize = 5)
+#parameter of Lucas-Kanade method
+LK_PARAMS = dict(winSize = (20, 20),
+                    maxLevel = 5,
+                    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+def feature_params():
     """
-    calculate fix direction for each time point.
-    fixDirection_arr[page][time] = fixDirectionX, fixDirectionY, fixDirectionZ
-    (page: 1 ~ PAGE_MAX, time: 1 ~ TIME_MAX)
+    FEATURE_PARAMS for the size of the images (minDistance is in pixels at full resolution)
+    """
+    return dict(FEATURE_PARAMS, minDistance=FEATURE_PARAMS["minDistance"] / ciputil.SCALE)
+
+def get_binarization(gray):
+    """
+    Threshold is determined by the Otsu algorithm
     """
-    def get_feature(prevImg, nextImg, prevFeature):
-        assert prevImg.shape == nextImg.shape
-        #parameter of Lucas-Kanade method
-        lk_params = dict(winSize = (20, 20),
-                            maxLevel = 5,
-                            criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
-        if len(prevImg.shape) == 3:
-            prevImg = cv2.cvtColor(prevImg, cv2.COLOR_BGR2GRAY)
-            nextImg = cv2.cvtColor(nextImg, cv2.COLOR_BGR2GRAY)
-            nextFeature, status, err = cv2.calcOpticalFlowPyrLK(prevImg, nextImg, prevFeature, None, **lk_params)
-            prevFeatureFiltered = prevFeature[status == 1]
-            nextFeatureFiltered = nextFeature[status == 1]
-        return prevFeatureFiltered, nextFeatureFiltered
-
-    def get_binarization(gray):
-        """
-        Threshold is determined by the Otsu algorithm
-        """
-        _, binaryImg = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        return binaryImg
-
-    def calc_sparseFlow(prevFeatureFiltered, nextFeatureFiltered):
-        sparseFlow = np.zeros((nextFeatureFiltered.shape[0],3))
-        for i, (prevPoint, nextPoint) in enumerate(zip(prevFeatureFiltered, nextFeatureFiltered)):
-            prevX, prevY = prevPoint.ravel()
-            nextX, nextY = nextPoint.ravel()
-            sparseFlow[i][0] = nextX - prevX
-            sparseFlow[i][1] = nextY - prevY
-        return sparseFlow
-
-    def calc_movement(sparseFlow):
+    _, binaryImg = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binaryImg
+
+def get_feature(prevGray, nextGray, prevFeature):
+    """
+    track prevFeature from prevGray to nextGray.
+    return tracked features of prev and next
+    """
+    assert prevGray.shape == nextGray.shape
+    if prevFeature is None:
+        raise FeatureError("Not detect feature")
+    nextFeature, status, err = cv2.calcOpticalFlowPyrLK(prevGray, nextGray, prevFeature, None, **LK_PARAMS)
+    prevFeatureFiltered = prevFeature[status == 1]
+    nextFeatureFiltered = nextFeature[status == 1]
+    return prevFeatureFiltered, nextFeatureFiltered
+
+def calc_sparseFlow(prevFeatureFiltered, nextFeatureFiltered):
+    """
+    return sparseFlow[num of features][3] (x, y, z=0)
+    """
+    sparseFlow = np.zeros((nextFeatureFiltered.shape[0],3))
+    sparseFlow[:, :2] = (nextFeatureFiltered - prevFeatureFiltered).reshape(-1, 2)
+    return sparseFlow
+
+def calc_movement(sparseFlow):
+    try:
+        meanX, meanY, meanZ = np.mean(sparseFlow, axis=0)
+    except ZeroDivisionError:
+        meanX, meanY, meanZ = 0, 0, 0
+    movement = np.array([meanX, meanY, meanZ])
+    return movement
+
+def calc_angle_variance(sparseFlow):
+    filterSparseFlow = sparseFlow.copy()
+    filterSparseFlow[filterSparseFlow <= 5 / ciputil.SCALE] = 0  # 5 pixels at full resolution
+    filterSparseFlowX = filterSparseFlow[:, 0]
+    filterSparseFlowY = filterSparseFlow[:, 1]
+    angle_arr = np.arctan2(filterSparseFlowX, filterSparseFlowY) * 180 / np.pi
+    angleVar = np.var(angle_arr)
+    return angleVar
+
+def normalized_variance(angleVar_arr):
+    varMax = np.amax(angleVar_arr)
+    if varMax != 0:
+        normAngleVar_arr = angleVar_arr / varMax
+    else:
+        return angleVar_arr
+    return normAngleVar_arr
+
+def calc_page_movement(page):
+    """
+    calculate movement of a page between time - 1 and time, using only the images of the page.
+    return movement_arr[time+1][3], angleVar_arr[time+1], featureError_arr[time+1]
+    featureError_arr[time] is True when features are not detected. (movement is filled later from page - 1)
+    the grayscale image and its features of time are reused as prev of time + 1.
+    """
+    movement_arr = np.zeros((TIME_MAX + 1, 3))
+    angleVar_arr = np.zeros(TIME_MAX + 1)
+    featureError_arr = np.zeros(TIME_MAX + 1, bool)
+
+    gray_iter = ciputil.frames(ciputil.LEVEL, page, gray=True)
+    _, prevGray = next(gray_iter)
+    prevFeature = cv2.goodFeaturesToTrack(prevGray, mask=get_binarization(prevGray), **feature_params())
+    for time, nextGray in gray_iter:
         try:
-            meanX, meanY, meanZ = np.mean(sparseFlow, axis=0)
-        except ZeroDivisionError:
-            meanX, meanY, meanZ = 0, 0, 0
-        movement = np.array([meanX, meanY, meanZ])
-        return movement
-
-    def calc_angle_variance(sparseFlow):
-        filterSparseFlow = sparseFlow.copy()
-        filterSparseFlow[filterSparseFlow <= 5] = 0
-        filterSparseFlowX = filterSparseFlow[:, 0]
-        filterSparseFlowY = filterSparseFlow[:, 1]
-        angle_arr = np.arctan2(filterSparseFlowX, filterSparseFlowY) * 180 / np.pi
-        angleVar = np.var(angle_arr)
-        return angleVar
-
-    def normalized_variance(angleVar_arr):
-        varMax = np.amax(angleVar_arr)
-        if varMax != 0:
-            normAngleVar_arr = angleVar_arr / varMax
-        else:
-            return angleVar_arr
-        return normAngleVar_arr
+            prevFeatureFiltered, nextFeatureFiltered = get_feature(prevGray, nextGray, prevFeature)
+            if prevFeatureFiltered.shape[0] <= 50 // ciputil.SCALE**2:  # features are fewer on a downsampled image
+                raise FeatureError("Not detect feature")
+            sparseFlow = calc_sparseFlow(prevFeatureFiltered, nextFeatureFiltered)
+            angleVar_arr[time] = calc_angle_variance(sparseFlow)
+            movement_arr[time] = calc_movement(sparseFlow)
+        except FeatureError:
+            featureError_arr[time] = True
+        prevGray = nextGray
+        if time < TIME_MAX:
+            prevFeature = cv2.goodFeaturesToTrack(prevGray, mask=get_binarization(prevGray), **feature_params())
+    instrument.add_work(TIME_MAX, TIME_MAX * prevGray.size)
+    return movement_arr, angleVar_arr, featureError_arr
 
+def reduce_fix_direction(movement_arr, angleVar_arr, featureError_arr, angleThresh):
+    """
+    cross-page part of calc_fix_direction. pages are processed in order, since a page falls back to page - 1.
+        1. movement of a time without features is copied from page - 1
+        2. movement of a time whose normalized angle variance >= angleThresh is copied from page - 1
+        3. fixDirection is the cumulative sum of movement over time
+    return fixDirection_arr[page+1][time+1][3]
+    """
+    movement_arr = movement_arr.copy()
+    for page in range(1, PAGE_MAX+1):
+        error_arr = featureError_arr[page]
+        movement_arr[page][error_arr] = movement_arr[page-1][error_arr]
+
+    normAngleVar_arr = normalized_variance(angleVar_arr)
+    for page in range(1, PAGE_MAX+1):
+        unreliable_arr = normAngleVar_arr[page] >= angleThresh
+        unreliable_arr[:2] = False  # movement is defined from time = 2
+        movement_arr[page][unreliable_arr] = movement_arr[page-1][unreliable_arr]
 
     fixDirection_arr = np.zeros((PAGE_MAX + 1,TIME_MAX + 1, 3))  # +1 to adjust to 1 origin of time
-    allPage_fixDirection_arr = np.zeros((TIME_MAX + 1, 3))
-    latestMovement = np.array([0, 0, 0])
+    #movement of time = 1 is 0, so fixDirection of time = 1 is 0 and fixDirection[time] = fixDirection[time - 1] + movement[time]
+    fixDirection_arr[1:, 1:] = np.cumsum(movement_arr[1:, 1:], axis=1)
+    return fixDirection_arr
+
+@instrument.measured("stabilize")
+def calc_page_movement_worker(level, page, configFilepath="./config/config.ini"):
+    """
+    calc_page_movement in a worker process.
+    """
+    global TIME_MAX
+    global PAGE_MAX
+
+    TIME_MAX, PAGE_MAX, _ = ciputil.read_config(configFilepath, level)
+    return calc_page_movement(page)
+
+def calc_fix_direction_parallel(angleThresh, level, workers, retry, configFilepath="./config/config.ini"):
+    """
+    same as calc_fix_direction, but movement of each page is calculated in a process pool.
+    the cross-page fallbacks are applied afterwards by a single serial reduce_fix_direction,
+    so the result is identical to calc_fix_direction.
+    """
     angleVar_arr = np.zeros((PAGE_MAX+1, TIME_MAX+1))
     movement_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1, 3))
+    featureError_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1), bool)
 
-    feature_params = dict(maxCorners = 200,
-                            qualityLevel = 0.001,
-                            minDistance = 10,
-                            blockSize = 5)
-
-    for time in range(2, TIME_MAX+1):
-        for page in range(1, PAGE_MAX + 1):
-            prevImg = ciputil.get_image(time=time-1, page=page)
-            prevGray = cv2.cvtColor(prevImg, cv2.COLOR_BGR2GRAY)
-            nextImg = ciputil.get_image(time=time, page=page)
-            flowMask = get_binarization(prevGray)
-            prevFeature = cv2.goodFeaturesToTrack(prevGray, mask=flowMask, **feature_params)
-            try:
-                prevFeatureFiltered, nextFeatureFiltered = get_feature(prevImg, nextImg, prevFeature)
-                if prevFeatureFiltered.shape[0] <= 50:
-                    raise FeatureError("Not detect feature")
-                sparseFlow = calc_sparseFlow(prevFeatureFiltered, nextFeatureFiltered)
-                prevFeature = nextFeatureFiltered.reshape(-1, 1, 2)
-                angleVar = calc_angle_variance(sparseFlow)
-                angleVar_arr[page][time] = angleVar
-                movement_arr[page][time] = calc_movement(sparseFlow)
-            except FeatureError:
-                movement_arr[page][time] = movement_arr[page-1][time]
+    result_dct, failed_lst = ciputil.run_pages(calc_page_movement_worker, level, range(1, PAGE_MAX + 1),
+                                               workers, retry, configFilepath)
+    if len(failed_lst) > 0:
+        print("FAILED: movement of pages = {}".format(failed_lst))
+        sys.exit(1)
+    for page in range(1, PAGE_MAX + 1):
+        movement_arr[page], angleVar_arr[page], featureError_arr[page] = result_dct[page]
+    return reduce_fix_direction(movement_arr, angleVar_arr, featureError_arr, angleThresh)
 
-    normAngleVar_arr = normalized_variance(angleVar_arr)
-    for time in range(2, TIME_MAX+1):
-        for page in range(1, PAGE_MAX+1):
-            if normAngleVar_arr[page][time] >= angleThresh:
-                movement_arr[page][time] = movement_arr[page-1][time]
-            for i in range(3):
-                fixDirection_arr[page][time][i] = fixDirection_arr[page][time - 1][i] + movement_arr[page][time][i]
-    return fixDirection_arr
+def dump_fix_direction(level, result_dct, configFilepath="./config/config.ini"):
+    """
+    reduce the results of calc_page_movement_worker (page -> movement, angleVar, featureError)
+    into fixDirection_arr and dump it. used by the batch runner, whose pool computes the movements.
+    return filepath of the dumped fixDirection_arr.
+    """
+    global TIME_MAX
+    global PAGE_MAX
+
+    TIME_MAX, PAGE_MAX, _ = ciputil.read_config(configFilepath, level)
+    angleThresh, dumpFilepath, _ = ciputil.read_config_stabilize(configFilepath)
+    angleVar_arr = np.zeros((PAGE_MAX+1, TIME_MAX+1))
+    movement_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1, 3))
+    featureError_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1), bool)
+    for page in range(1, PAGE_MAX + 1):
+        movement_arr[page], angleVar_arr[page], featureError_arr[page] = result_dct[page]
+    fixDirection_arr = reduce_fix_direction(movement_arr, angleVar_arr, featureError_arr, angleThresh)
+
+    dumpFilepath = dumpFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
+    np.save(dumpFilepath, fixDirection_arr)
+    return dumpFilepath
+
+def calc_fix_direction(angleThresh):
+    """
+    calculate fix direction for each time point.
+    fixDirection_arr[page][time] = fixDirectionX, fixDirectionY, fixDirectionZ
+    (page: 1 ~ PAGE_MAX, time: 1 ~ TIME_MAX)
+    """
+    angleVar_arr = np.zeros((PAGE_MAX+1, TIME_MAX+1))
+    movement_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1, 3))
+    featureError_arr = np.zeros((PAGE_MAX + 1, TIME_MAX + 1), bool)
+
+    for page in range(1, PAGE_MAX + 1):
+        with instrument.measure("stabilize", ciputil.LEVEL, page):
+            movement_arr[page], angleVar_arr[page], featureError_arr[page] = calc_page_movement(page)
+    return reduce_fix_direction(movement_arr, angleVar_arr, featureError_arr, angleThresh)
 
 
 def output_stabilized_video(fixDirection_arr, videoFilepath, configFilepath):
@@ -145,13 +235,11 @@ def output_stabilized_video(fixDirection_arr, videoFilepath, configFilepath):
         pageLast = pageFirst
     print("START: output video to {}, pageFirst: {}, pageLast: {}".format(videoFilepath, pageFirst, pageLast))
 
-    fourcc = int(cv2.VideoWriter_fourcc(*'avc1'))
-    video = cv2.VideoWriter(videoFilepath, fourcc, 5.0, (960, 960))
-    waitImg = np.zeros((960, 960, 3), np.uint8)  # image for waiting
+    video = render.VideoWriter(videoFilepath, 5.0, (ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE), ciputil.VIDEO_QUEUE)
+    waitImg = np.zeros((ciputil.CANVAS_SIZE, ciputil.CANVAS_SIZE, 3), np.uint8)  # image for waiting
 
     for page in range(pageFirst, pageLast + 1):
-        for time in range(1, TIME_MAX + 1):
-            img = ciputil.get_image(time=time, page=page)
+        for time, img in ciputil.frames(ciputil.LEVEL, page, stride=ciputil.VIDEO_STRIDE):
             fixImg = ciputil.get_stabilized_image(img, fixDirection_arr[page][time])
 
             data = "[page: {0:03d} time: {1:03d}]".format(page, time)
@@ -173,9 +261,14 @@ def main(level):
 
     configFilepath = "./config/config.ini"
     TIME_MAX, PAGE_MAX, OUTPUT_VIDEO = ciputil.read_config(configFilepath, level)
+    instrument.configure(configFilepath)
     print("level = {}".format(level))
     angleThresh, dumpFilepath, videoFilepath = ciputil.read_config_stabilize(configFilepath)
-    fixDirection_arr = calc_fix_direction(angleThresh)
+    workers, retry = ciputil.read_config_pipeline(configFilepath)
+    if workers > 1:
+        fixDirection_arr = calc_fix_direction_parallel(angleThresh, level, workers, retry, configFilepath)
+    else:
+        fixDirection_arr = calc_fix_direction(angleThresh)
     dumpFilepath =  dumpFilepath.replace("fixDir.npy", str(level) + "_fixDir.npy")
     np.save(dumpFilepath, fixDirection_arr)
     print("DONE:  calcurate fix direction")
@@ -186,6 +279,6 @@ def main(level):
 
 if __name__ == "__main__":
     start = time.time()
-    main()
+    main(ciputil.get_level(sys.argv))
     elapse = time.time() - start
     print('\nelapse time: {} sec'.format(elapse))
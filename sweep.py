@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+# coding: utf-8
+
+"""
+parameter sweep: run the stages for every combination of a grid of config values,
+computing each distinct intermediate result only once.
+
+a combination (variant) is the config "config/config.ini" with some values replaced.
+the output of a stage depends only on the config values of the stage (artifact.STAGE_CONFIG) and on the output
+of the stage before it, so the variants share the nodes of a tree:
+    stabilize  : fixDir of the level
+    cumulative : cml of the pages, child of a stabilize node
+    dot        : dot products of the pages, child of a cumulative node
+    detect     : answer file, child of a dot node
+e.g. variants differing only in [DETECT] DOT_THRESHOLD share everything up to their dot node.
+a node is identified by its key (artifact.stage_key of its config values and the key of its parent)
+and is computed once into DIRPATH/{stage}_{key}, however many variants share it.
+the cumulative nodes of a stabilize node are computed together, so the dense flows of a page are calculated
+once for all of them (see cumulative_flow.run_page_variants).
+a node whose manifests are up to date (see artifact.py) is skipped, so a sweep can be extended and rerun.
+
+the result of each variant (grid values, nodes, number of divisions and answer file) goes to DIRPATH/results_{level}.csv.
+the pages are run on a pool of [PIPELINE] WORKERS processes.
+
+usage: ./sweep.py [level] --grid SECTION.KEY=VALUE,VALUE ... [--dirpath DIRPATH]
+    e.g. ./sweep.py 2 --grid CUMULATIVE.WINDOW_SIZE=5,10 DOT.FLOW_THRESHOLD=5,10 DETECT.DOT_THRESHOLD=-10,-20
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ciputil
+import artifact
+import stabilize
+import cumulative_flow
+import dot_product
+import pipeline
+
+STAGES = pipeline.STAGES
+
+#config value pointing each stage at the directory of its node
+NODE_FILEPATH = {
+    "stabilize" : ("STABILIZE", "DUMP_FILEPATH", "fixDir.npy"),
+    "cumulative": ("CUMULATIVE", "DUMP_FILEPATH", "cml.npy"),
+    "dot"       : ("DOT", "DUMP_FILEPATH", "dot.npy"),
+    "detect"    : ("DETECT", "ANSWER_FILEPATH", "output.csv"),
+}
+
+
+def parse_grid(text):
+    """
+    "SECTION.KEY=VALUE,VALUE" -> ((SECTION, KEY), [VALUE, VALUE])
+    """
+    name, values = text.split("=", 1)
+    section, key = name.split(".", 1)
+    return (section.upper(), key.upper()), values.split(",")
+
+def expand_grid(grid_lst):
+    """
+    return list of variants {(section, key): value}, one for each combination of the values of grid_lst
+    """
+    name_lst = [name for name, _ in grid_lst]
+    return [dict(zip(name_lst, value_lst)) for value_lst in itertools.product(*[value_lst for _, value_lst in grid_lst])]
+
+def make_variant_config(configFilepath, variant):
+    config = ciputil.set_config(configFilepath)
+    for (section, key), value in variant.items():
+        if not config.has_option(section, key):
+            print("Unknown config value: {}.{}".format(section, key))
+            sys.exit(1)
+        config[section][key] = value
+    config["DEFAULT"]["OUTPUT_VIDEO"] = "no"
+    config["CANDIDATES"]["FUSED"] = "no"  # the dot nodes are shared by the variants of DETECT
+    return config
+
+def node_keys(config, level, fingerprint_lst):
+    """
+    return {stage: key} of the nodes of a variant. the key of a node includes the key of its parent.
+    """
+    key_dct = {}
+    parent = (level, ciputil.get_scale(config), fingerprint_lst)
+    for stage in STAGES:
+        key_dct[stage] = artifact.stage_key(stage, config, parent)
+        parent = key_dct[stage]
+    return key_dct
+
+def node_dirpath(dirpath, stage, key):
+    return dirpath + "/{0}_{1}".format(stage, key[:12])
+
+def run_tasks(executor, task_dct, on_done):
+    """
+    run task_dct {name: (function, args)} on executor, and call on_done(name, output) as each task finishes
+    """
+    future_dct = {executor.submit(function, *args): name for name, (function, args) in task_dct.items()}
+    for future in as_completed(future_dct):
+        on_done(future_dct[future], future.result())
+
+def run_stabilize(executor, level, node_dct, page_lst):
+    pending_lst = [key for key, (_, nodeDirpath, _) in node_dct.items()
+                   if not artifact.is_up_to_date(nodeDirpath, "stabilize", level, None, key)]
+    print("START: stabilize, nodes = {}, up to date = {}".format(len(pending_lst), len(node_dct) - len(pending_lst)))
+    task_dct = {(key, page): (stabilize.calc_page_movement_worker, (level, page, node_dct[key][0]))
+                for key in pending_lst for page in page_lst}
+    result_dct = {key: {} for key in pending_lst}
+
+    def on_done(name, output):
+        key, page = name
+        result_dct[key][page] = output
+
+    run_tasks(executor, task_dct, on_done)
+    for key in pending_lst:
+        variantConfigFilepath, nodeDirpath, _ = node_dct[key]
+        output = stabilize.dump_fix_direction(level, result_dct[key], variantConfigFilepath)
+        artifact.record(nodeDirpath, "stabilize", level, None, key, output)
+
+def run_cumulative(executor, level, node_dct, page_lst):
+    """
+    pages of the cumulative nodes of the same stabilize node (and the same REDUCED_GRID and flow backend) are run as one task
+    """
+    group_dct = {}
+    for key, (variantConfigFilepath, _, parentKey) in node_dct.items():
+        reducedGrid = ciputil.read_config_cumulative(variantConfigFilepath)[6]
+        backend = ciputil.read_config_flow(variantConfigFilepath)
+        group_dct.setdefault((parentKey, reducedGrid, backend), []).append(key)
+
+    task_dct = {}
+    for key_lst in group_dct.values():
+        for page in page_lst:
+            pending_lst = [key for key in key_lst if not artifact.is_up_to_date(node_dct[key][1], "cumulative", level, page, key)]
+            if len(pending_lst) > 0:
+                task_dct[(tuple(pending_lst), page)] = (cumulative_flow.run_page_variants,
+                                                        (level, page, [node_dct[key][0] for key in pending_lst]))
+    print("START: cumulative, nodes = {}, tasks = {}".format(len(node_dct), len(task_dct)))
+
+    def on_done(name, output_lst):
+        key_lst, page = name
+        for key, output in zip(key_lst, output_lst):
+            artifact.record(node_dct[key][1], "cumulative", level, page, key, output)
+
+    run_tasks(executor, task_dct, on_done)
+
+def run_stage(executor, stage, level, node_dct, page_lst):
+    """
+    run the (node, page) of dot, or the node of detect (page_lst = [None]), which are not up to date
+    """
+    function = {"dot": dot_product.run_page, "detect": pipeline.run_detect}[stage]
+    task_dct = {(key, page): (function, (level, page, variantConfigFilepath))
+                for key, (variantConfigFilepath, nodeDirpath, _) in node_dct.items() for page in page_lst
+                if not artifact.is_up_to_date(nodeDirpath, stage, level, page, key)}
+    print("START: {}, nodes = {}, tasks = {}".format(stage, len(node_dct), len(task_dct)))
+
+    def on_done(name, output):
+        key, page = name
+        artifact.record(node_dct[key][1], stage, level, page, key, output)
+
+    run_tasks(executor, task_dct, on_done)
+
+def read_divisions(answerFilepath):
+    with open(answerFilepath, "r") as f:
+        f.readline()
+        return int(f.readline())
+
+def write_results(row_lst, resultsFilepath):
+    with open(resultsFilepath, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(row_lst[0]))
+        writer.writeheader()
+        writer.writerows(row_lst)
+
+def main(level, grid_lst, dirpath, configFilepath="./config/config.ini"):
+    """
+    return list of the results of the variants (see write_results)
+    """
+    workers, _ = ciputil.read_config_pipeline(configFilepath)
+    timeMax, pageMax, _ = ciputil.read_config(configFilepath, level)
+    page_lst = list(range(1, pageMax + 1))
+    fingerprint_lst = [artifact.image_fingerprint(page, timeMax) for page in page_lst]
+    #absolute, so that the node directories are not moved by the preview mode (see ciputil.preview_filepath)
+    dirpath = os.path.abspath(dirpath)
+
+    #stage -> key -> (config filepath of the first variant using the node, node directory, key of the parent node)
+    node_dct = {stage: {} for stage in STAGES}
+    variant_lst = expand_grid(grid_lst)
+    row_lst = []
+    for variant in variant_lst:
+        config = make_variant_config(configFilepath, variant)
+        key_dct = node_keys(config, level, fingerprint_lst)
+        nodeDirpath_dct = {stage: node_dirpath(dirpath, stage, key_dct[stage]) for stage in STAGES}
+        for stage, (section, key, filename) in NODE_FILEPATH.items():
+            os.makedirs(nodeDirpath_dct[stage], exist_ok=True)
+            config[section][key] = nodeDirpath_dct[stage] + "/" + filename
+        variantConfigFilepath = nodeDirpath_dct["detect"] + "/config.ini"
+        with open(variantConfigFilepath, "w") as f:
+            config.write(f)
+
+        parentKey = None
+        for stage in STAGES:
+            node_dct[stage].setdefault(key_dct[stage], (variantConfigFilepath, nodeDirpath_dct[stage], parentKey))
+            parentKey = key_dct[stage]
+
+        row = {"{0}.{1}".format(section, key): value for (section, key), value in variant.items()}
+        row.update({stage: os.path.basename(nodeDirpath_dct[stage]) for stage in STAGES})
+        row["answer"] = nodeDirpath_dct["detect"] + "/output{}.csv".format(level)
+        row_lst.append(row)
+    print("START: sweep, level = {}, variants = {}, nodes = {}".format(
+        level, len(variant_lst), ", ".join("{} {}".format(stage, len(node_dct[stage])) for stage in STAGES)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        run_stabilize(executor, level, node_dct["stabilize"], page_lst)
+        run_cumulative(executor, level, node_dct["cumulative"], page_lst)
+        run_stage(executor, "dot", level, node_dct["dot"], page_lst)
+        run_stage(executor, "detect", level, node_dct["detect"], [None])
+
+    for row in row_lst:
+        row["divisions"] = read_divisions(row["answer"])
+    resultsFilepath = dirpath + "/results_{}.csv".format(level)
+    write_results(row_lst, resultsFilepath)
+    for row in row_lst:
+        print(", ".join("{}={}".format(name, value) for name, value in row.items() if name not in STAGES + ["answer"]))
+    print("DONE: results are written to {}".format(resultsFilepath))
+    return row_lst
+
+if __name__ == "__main__":
+    start = time.time()
+    parser = argparse.ArgumentParser(prog="sweep.py", description="run the stages for a grid of config values")
+    parser.add_argument("level", nargs="?", type=int, help="level (default: LEVEL of config)")
+    parser.add_argument("--grid", nargs="+", type=parse_grid, required=True, help="SECTION.KEY=VALUE,VALUE")
+    parser.add_argument("--dirpath", default="./out/sweep", help="directory of the nodes and the results")
+    args = parser.parse_args()
+    main(args.level or ciputil.get_level([]), args.grid, args.dirpath)
+    elapse = time.time() - start
+    print("\nelapse time: {} sec".format(elapse))
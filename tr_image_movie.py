@@ -2,6 +2,10 @@
 
 """
 convert a series of 'images (.tif)' into 'movie (.mp4)' in time/depth order.
+images are read ahead in background threads, the frames of all divisions of an image are drawn together,
+and the video is encoded in a background thread (see render.py).
+for a quick look, --stride renders every STRIDE-th image of each sequence and --range only the sequences FIRST ~ LAST
+(pages for the time axis, times for the page axis).
 If you need help for this file, execute "python tr_image_movie.py -h".
 """
 
@@ -9,14 +13,19 @@ import sys
 import numpy as np
 import cv2
 import argparse
+import ciputil
+import render
 
+PREFETCH_DEPTH = 8  # images read ahead while the video is encoded
+PREFETCH_THREADS = 2
 
-def add_frame(img, frame):
-    assert len(frame)==4
-    cv2.rectangle(img, (frame[0], frame[1]), (frame[2], frame[3]), (0, 0, 255), 2)
-    return img
+def add_frames(img, frame_arr):
+    """
+    draw frames frame_arr[frames][4] = (ax, ay, bx, by) on img
+    """
+    return render.draw_boxes(img, frame_arr, (0, 0, 255), 2)
 
-def main(videoFilepath, level=1,axis='time'):
+def main(videoFilepath, level=1,axis='time', stride=1, outerRange=None):
 
     #--------------------------------------------------------------------------------
     # load config.txt
@@ -64,50 +73,63 @@ def main(videoFilepath, level=1,axis='time'):
     #--------------------------------------------------------------------------------
     # video output configuration
     #--------------------------------------------------------------------------------
-    fourcc = int(cv2.VideoWriter_fourcc(*'avc1'))
-    video = cv2.VideoWriter(videoFilepath,fourcc,10.0,(480,480))
+    video = render.VideoWriter(videoFilepath,10.0,(480,480))
     waitImg = np.zeros((480,480,3),np.uint8)#image for waiting
+    #[division][time] of the page range (az, bz) and the frame (ax, ay, bx, by) of the divisions
+    zrange_arr = np.array([time2zrange[1:] for time2zrange in time2zrange_lst], np.int64).reshape(numDivision, timeMax, 2)
+    frame_arr = np.array([time2frame[1:] for time2frame in time2frame_lst], np.int64).reshape(numDivision, timeMax, 4)
 
     #--------------------------------------------------------------------------------
     # output .mp4 in designated order
     #--------------------------------------------------------------------------------
     print("level: {}, axis: {}".format(level, axis))
     if axis == "time":
-        time_scale(timeMax,pageMax,level,direc,video,waitImg, time2zrange_lst, time2frame_lst)
+        time_scale(timeMax,pageMax,level,direc,video,waitImg, zrange_arr, frame_arr, stride, outerRange)
     elif axis == "page":
-        page_scale(timeMax,pageMax,level,direc,video,waitImg, time2zrange_lst, time2frame_lst)
+        page_scale(timeMax,pageMax,level,direc,video,waitImg, zrange_arr, frame_arr, stride, outerRange)
     else:
         print("Bad Axis Error: {}".format(axis))
         sys.exit(1)
     print("DONE: {}".format(videoFilepath))
 
 
-def time_scale(timeMax,pageMax,level,direc,video,waitImg, time2zrange_lst, time2frame_lst):
-    for page in range(1,pageMax+1):
-        for time in range(1,timeMax+1):
-            #filepath=direc+"/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
-            filepath = direc + "/evaluate/Eva_Data{0:02d}/t{1:03d}/Eva_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
-            img = cv2.imread(filepath)
-            for time2zrange, time2frame in zip(time2zrange_lst, time2frame_lst):
-                if time2zrange[time][0]<=page and page<=time2zrange[time][1]:
-                    img = add_frame(img, time2frame[time])
-            video.write(img)
-        for _ in range(10):
-            video.write(waitImg)
+def scan(video, waitImg, load, outer_lst, inner_lst, draw):
+    """
+    write load((outer, inner)) drawn by draw(img, outer, inner) for every inner of every outer,
+    and waitImg after the images of each outer
+    """
+    index_lst = [(outer, inner) for outer in outer_lst for inner in inner_lst]
+    for (outer, inner), img in ciputil.prefetch(load, index_lst, PREFETCH_DEPTH, PREFETCH_THREADS):
+        video.write(draw(img, outer, inner))
+        if inner == inner_lst[-1]:
+            for _ in range(10):
+                video.write(waitImg)
     video.release()
 
-def page_scale(timeMax,pageMax,level,direc,video,waitImg, time2zrange_lst, time2frame_lst):
-    for time in range(1,timeMax+1):
-        for page in range(1,pageMax+1):
-            filepath=direc+"/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
-            img = cv2.imread(filepath)
-            for time2zrange, time2frame in zip(time2zrange_lst, time2frame_lst):
-                if time2zrange[time][0]<=page and page<=time2zrange[time][1]:
-                    img = add_frame(img, time2frame[time])
-            video.write(img)
-        for _ in range(10):
-            video.write(waitImg)
-    video.release()
+def draw_divisions(img, time, page, zrange_arr, frame_arr):
+    alive_arr = (zrange_arr[:, time - 1, 0] <= page) & (page <= zrange_arr[:, time - 1, 1])
+    return add_frames(img, frame_arr[alive_arr, time - 1])
+
+def time_scale(timeMax,pageMax,level,direc,video,waitImg, zrange_arr, frame_arr, stride=1, pageRange=None):
+    def load(index):
+        page, time = index
+        #filepath=direc+"/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
+        filepath = direc + "/evaluate/Eva_Data{0:02d}/t{1:03d}/Eva_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
+        return cv2.imread(filepath)
+
+    pageFirst, pageLast = pageRange or (1, pageMax)
+    scan(video, waitImg, load, range(pageFirst, pageLast+1), range(1, timeMax+1)[::stride],
+         lambda img, page, time: draw_divisions(img, time, page, zrange_arr, frame_arr))
+
+def page_scale(timeMax,pageMax,level,direc,video,waitImg, zrange_arr, frame_arr, stride=1, timeRange=None):
+    def load(index):
+        time, page = index
+        filepath=direc+"/Pre_Data{0:02d}/t{1:03d}/Pre_Data{0:02d}_t{1:03d}_page_{2:04d}.tif".format(level, time, page)
+        return cv2.imread(filepath)
+
+    timeFirst, timeLast = timeRange or (1, timeMax)
+    scan(video, waitImg, load, range(timeFirst, timeLast+1), range(1, pageMax+1)[::stride],
+         lambda img, time, page: draw_divisions(img, time, page, zrange_arr, frame_arr))
 
 def make_parse():
     parser = argparse.ArgumentParser(prog='tr_image_movie.py',
@@ -117,13 +139,14 @@ def make_parse():
                                     add_help=True,
                                     )
 
-    parser.add_argument('Arg1: output file path',help='string',type=argparse.FileType('w'))
-    parser.add_argument('Arg2: select input image level',default=1,help='integer',type=int)
-    parser.add_argument('Arg3: select scale depth or time',default='time',help='string')
+    parser.add_argument('videoFilepath',metavar='Arg1: output file path',help='string')
+    parser.add_argument('level',metavar='Arg2: select input image level',nargs='?',default=1,help='integer',type=int)
+    parser.add_argument('axis',metavar='Arg3: select scale depth or time',nargs='?',default='time',help='string')
+    parser.add_argument('--stride',default=1,help='render every STRIDE-th image of each sequence',type=int)
+    parser.add_argument('--range',nargs=2,metavar=('FIRST','LAST'),help='render only pages (time axis) or times (page axis) FIRST ~ LAST',type=int)
 
-    args = parser.parse_args()
+    return parser.parse_args()
 
 if __name__=="__main__":
-    make_parse()
-    args = sys.argv
-    main(str(args[1]), int(args[2]),str(args[3]))
+    args = make_parse()
+    main(args.videoFilepath, args.level, args.axis, max(args.stride, 1), args.range)